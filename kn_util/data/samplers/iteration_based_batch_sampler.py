@@ -1,4 +1,6 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
+import itertools
+
 from torch.utils.data.sampler import BatchSampler
 
 
@@ -6,26 +8,58 @@ class IterationBasedBatchSampler(BatchSampler):
     """
     Wraps a BatchSampler, resampling from it until
     a specified number of iterations have been sampled
+
+    Every pass over the wrapped batch sampler calls `set_epoch` of the
+    underlying sampler with the iteration at which the pass started.
+    `state_dict`/`load_state_dict` resume in the middle of a pass: if the
+    wrapped sampler is a plain BatchSampler over a sampler with
+    `load_state_dict`, the underlying sampler jumps to the right position
+    directly; otherwise the batches already done in the pass are skipped.
     """
 
     def __init__(self, batch_sampler, num_iterations, start_iter=0):
         self.batch_sampler = batch_sampler
         self.num_iterations = num_iterations
         self.start_iter = start_iter
+        # iteration at which the current pass over batch_sampler started
+        self.pass_start = start_iter
+        self.iteration = start_iter
+
+    def state_dict(self):
+        return dict(iteration=self.iteration, pass_start=self.pass_start)
+
+    def load_state_dict(self, state):
+        self.start_iter = self.iteration = state["iteration"]
+        self.pass_start = state["pass_start"]
+
+    def _resume_pass(self, done):
+        """Return an iterator over the current pass, `done` batches into it."""
+        sampler = self.batch_sampler.sampler
+        if done > 0 and type(self.batch_sampler) is BatchSampler and hasattr(sampler, "load_state_dict"):
+            state = sampler.state_dict()
+            state.update(epoch=self.pass_start, position=done * self.batch_sampler.batch_size)
+            sampler.load_state_dict(state)
+            return iter(self.batch_sampler)
+        return itertools.islice(self.batch_sampler, done, None)
 
     def __iter__(self):
         iteration = self.start_iter
+        done = iteration - self.pass_start
         while iteration <= self.num_iterations:
             # if the underlying sampler has a set_epoch method, like
             # DistributedSampler, used for making each process see
             # a different split of the dataset, then set it
+            if done == 0:
+                self.pass_start = iteration
             if hasattr(self.batch_sampler.sampler, "set_epoch"):
-                self.batch_sampler.sampler.set_epoch(iteration)
-            for batch in self.batch_sampler:
+                self.batch_sampler.sampler.set_epoch(self.pass_start)
+            for batch in self._resume_pass(done):
                 iteration += 1
                 if iteration > self.num_iterations:
                     break
+                self.iteration = iteration
                 yield batch
+            done = 0
 
     def __len__(self):
         return self.num_iterations
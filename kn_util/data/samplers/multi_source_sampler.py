@@ -93,24 +93,45 @@ class MultiSourceSampler(Sampler):
 
         self.seed = sync_random_seed() if seed is None else seed
         self.shuffle = shuffle
+        # number of indices yielded so far
+        self.position = 0
+        # whether the next iteration resumes at a loaded position
+        self._resume = False
         self.source2inds = {source: self._indices_of_rank(len(ds)) for source, ds in enumerate(dataset.datasets)}
 
-    def _infinite_indices(self, sample_size: int) -> Iterator[int]:
-        """Infinitely yield a sequence of indices."""
+    def _infinite_indices(self, sample_size: int, start: int = 0) -> Iterator[int]:
+        """Infinitely yield a sequence of indices, beginning at position `start`.
+
+        Every pass over the source is shuffled with its own seed, so any
+        position can be reached without generating the passes before it.
+        """
         g = torch.Generator()
-        g.manual_seed(self.seed)
+        loop, offset = divmod(start, sample_size)
         while True:
             if self.shuffle:
-                yield from torch.randperm(sample_size, generator=g).tolist()
+                g.manual_seed(self.seed + loop)
+                indices = torch.randperm(sample_size, generator=g).tolist()
             else:
-                yield from torch.arange(sample_size).tolist()
+                indices = torch.arange(sample_size).tolist()
+            yield from indices[offset:]
+            loop, offset = loop + 1, 0
 
-    def _indices_of_rank(self, sample_size: int) -> Iterator[int]:
-        """Slice the infinite indices by rank."""
-        yield from itertools.islice(self._infinite_indices(sample_size), self.rank, None, self.world_size)
+    def _indices_of_rank(self, sample_size: int, consumed: int = 0) -> Iterator[int]:
+        """Slice the infinite indices by rank, skipping the first `consumed` of this rank."""
+        start = self.rank + consumed * self.world_size
+        yield from itertools.islice(self._infinite_indices(sample_size, start), 0, None, self.world_size)
 
     def __iter__(self) -> Iterator[int]:
         batch_buffer = []
+        if self._resume:
+            # a resumed position may be in the middle of a batch
+            skip = self.position % self.batch_size
+        else:
+            # an abandoned iteration may have stopped in the middle of a batch, all
+            # of whose indices were drawn from the sources already
+            skip = 0
+            self.position = -(-self.position // self.batch_size) * self.batch_size
+        self._resume = False
         while True:
             for source, num in enumerate(self.num_per_source):
                 batch_buffer_per_source = []
@@ -120,8 +141,11 @@ class MultiSourceSampler(Sampler):
                     if len(batch_buffer_per_source) == num:
                         batch_buffer += batch_buffer_per_source
                         break
-            yield from batch_buffer
+            for idx in batch_buffer[skip:]:
+                self.position += 1
+                yield idx
             batch_buffer = []
+            skip = 0
 
     def __len__(self) -> int:
         return len(self.dataset)
@@ -130,12 +154,34 @@ class MultiSourceSampler(Sampler):
         """Not supported in `epoch-based runner."""
         pass
 
+    def state_dict(self) -> dict:
+        """Return the seed and the number of indices yielded so far.
+
+        The sampler is infinite, so there is no epoch. Note that a DataLoader
+        requests indices ahead of the training loop; for an exact resume,
+        store the number of consumed samples as `position`.
+        """
+        return dict(epoch=0, seed=self.seed, position=self.position)
+
+    def load_state_dict(self, state: dict) -> None:
+        """Continue from a `state_dict`, without replaying earlier indices."""
+        self.seed = state["seed"]
+        self.position = state["position"]
+        self._resume = True
+        batches = self.position // self.batch_size
+        self.source2inds = {
+            source: self._indices_of_rank(len(ds), batches * self.num_per_source[source])
+            for source, ds in enumerate(self.dataset.datasets)
+        }
+
 
 class GroupMultiSourceSampler(MultiSourceSampler):
     r"""Group Multi-Source Infinite Sampler.
 
     According to the sampling ratio, sample data from different
-    datasets but the same group to form batches.
+    datasets but the same group to form batches. The group of every batch
+    is drawn from a generator seeded with `seed`, so the sampler can be
+    resumed from a `state_dict`.
 
     Args:
         dataset (Sized): The dataset.
@@ -158,11 +204,36 @@ class GroupMultiSourceSampler(MultiSourceSampler):
         super().__init__(dataset=dataset, batch_size=batch_size, source_ratio=source_ratio, shuffle=shuffle, seed=seed)
 
         self._get_source_group_info()
+        self._seek_groups(0)
+
+    def _seek_groups(self, batches: int) -> None:
+        """Position the group generator and the index streams after `batches` batches.
+
+        The group of every batch is drawn from a generator seeded with
+        `seed`, so the groups of the skipped batches are drawn again (in one
+        vectorized call, without generating their indices) to find out how
+        far the index streams of each group have advanced.
+        """
+        self.group_rng = np.random.default_rng(self.seed)
+        groups = self.group_rng.choice(len(self.group_ratio), size=batches, p=self.group_ratio)
+        group_batches = np.bincount(groups, minlength=len(self.group_ratio))
         self.group_source2inds = [
-            {source: self._indices_of_rank(self.group2size_per_source[source][group]) for source in range(len(dataset.datasets))}
+            {
+                source: self._indices_of_rank(
+                    self.group2size_per_source[source][group], int(group_batches[group]) * self.num_per_source[source]
+                )
+                for source in range(len(self.dataset.datasets))
+            }
             for group in range(len(self.group_ratio))
         ]
 
+    def load_state_dict(self, state: dict) -> None:
+        """Continue from a `state_dict`, without replaying earlier indices."""
+        self.seed = state["seed"]
+        self.position = state["position"]
+        self._resume = True
+        self._seek_groups(self.position // self.batch_size)
+
     def _get_source_group_info(self) -> None:
         self.group2size_per_source = [{0: 0, 1: 0}, {0: 0, 1: 0}]
         self.group2inds_per_source = [{0: [], 1: []}, {0: [], 1: []}]
@@ -182,8 +253,14 @@ class GroupMultiSourceSampler(MultiSourceSampler):
 
     def __iter__(self) -> Iterator[int]:
         batch_buffer = []
+        if self._resume:
+            skip = self.position % self.batch_size
+        else:
+            skip = 0
+            self.position = -(-self.position // self.batch_size) * self.batch_size
+        self._resume = False
         while True:
-            group = np.random.choice(list(range(len(self.group_ratio))), p=self.group_ratio)
+            group = self.group_rng.choice(len(self.group_ratio), p=self.group_ratio)
             for source, num in enumerate(self.num_per_source):
                 batch_buffer_per_source = []
                 for idx in self.group_source2inds[group][source]:
@@ -192,5 +269,8 @@ class GroupMultiSourceSampler(MultiSourceSampler):
                     if len(batch_buffer_per_source) == num:
                         batch_buffer += batch_buffer_per_source
                         break
-            yield from batch_buffer
+            for idx in batch_buffer[skip:]:
+                self.position += 1
+                yield idx
             batch_buffer = []
+            skip = 0
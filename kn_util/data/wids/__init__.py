@@ -12,4 +12,5 @@ from .wids import (
     ShardListDataset,
     DistributedLocalSampler,
 )
+from .wids_tarindex import shm_index_file
 from .wids_utils import get_file_lengths
@@ -1,12 +1,13 @@
 import base64
-import gzip
+import collections
 import hashlib
+import heapq
 import io
 import os, os.path as osp
 import random
 import re
-import sqlite3
 import sys
+import time
 import uuid
 import warnings
 from functools import partial
@@ -19,11 +20,17 @@ import torch.distributed as dist
 
 from .wids_dl import download_and_open
 from .wids_lru import LRUCache
-from .wids_mmtar import MMIndexedTar
+from .wids_cleanup import ShardDiskCache, cache_index
+from .wids_decode import Decoder, load_npy, read_buffer
+from .wids_prefetch import ShardPrefetcher
+from .wids_remote import RemoteIndexedTar
+from .wids_shards import ShardTable
+from .wids_mmtar import MemoryViewIO, MMIndexedTar, keep_while_reading, pin_while_reading
 from .wids_specs import load_dsdesc_and_resolve, urldir
 from .wids_tar import TarFileReader, find_index_file
-from .wids_utils import get_file_lengths
-from ...dist import get_world_size, is_main_process, all_gather_object
+from .wids_tarindex import group_members
+from .wids_utils import get_file_lengths_distributed
+from ...dist import get_world_size, is_main_process
 
 try:
     from torch.utils.data import Dataset, Sampler
@@ -111,91 +118,26 @@ def group_by_key(names):
         A list of lists of indices, where each sublist contains indices of files
         with the same key.
     """
-    groups = []
-    kmaps = {}
-    for i, fname in enumerate(names):
-        # Ignore files that are not in a subdirectory.
-        if "." not in fname:
-            logger.warning(f"Warning: Ignoring file {fname} (no '.')")
-            continue
-        if fname == ".":
-            logger.warning(f"Warning: Ignoring the '.' file.")
-            continue
-        key, ext = splitname(fname)
-        if key not in kmaps:
-            kmaps[key] = []
-        kmaps[key].append(i)
-    for k, v in kmaps.items():
-        groups.append(v)
-    return groups
+    groups = group_members(names)
+    order, offsets = groups["sample_order"], groups["sample_offsets"].tolist()
+    return [order[lo:hi].tolist() for lo, hi in zip(offsets[:-1], offsets[1:])]
 
 
-def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] = True):
+def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] = True, image_size=None):
     """A default decoder for webdataset.
 
     This handles common file extensions: .txt, .cls, .cls2,
         .jpg, .png, .json, .npy, .mp, .pt, .pth, .pickle, .pkl.
     These are the most common extensions used in webdataset.
-    For other extensions, users can provide their own decoder.
+    For other extensions, users can provide their own decoder
+    (see `wids_decode.register_decoder` and `wids_decode.Decoder`).
 
     Args:
-        sample: sample, modified in place
+        sample: sample, which is copied rather than modified
+        image_size: decode images at reduced resolution, resized to this size
+            (an int for the shorter side or a (width, height) pair)
     """
-    sample = dict(sample)
-    for key, stream in sample.items():
-        extensions = key.split(".")
-        if len(extensions) < 1:
-            continue
-        extension = extensions[-1]
-        if extension in ["gz"]:
-            decompressed = gzip.decompress(stream.read())
-            stream = io.BytesIO(decompressed)
-            if len(extensions) < 2:
-                sample[key] = stream
-                continue
-            extension = extensions[-2]
-        if key.startswith("__"):
-            continue
-        elif extension in ["txt", "text"]:
-            value = stream.read()
-            sample[key] = value.decode("utf-8")
-        elif extension in ["cls", "cls2"]:
-            value = stream.read()
-            sample[key] = int(value.decode("utf-8"))
-        elif extension in ["jpg", "png", "ppm", "pgm", "pbm", "pnm"]:
-            if format == "PIL":
-                import PIL.Image
-
-                sample[key] = PIL.Image.open(stream)
-            elif format == "numpy":
-                import numpy as np
-
-                sample[key] = np.asarray(PIL.Image.open(stream))
-            else:
-                raise ValueError(f"Unknown format: {format}")
-        elif extension == "json":
-            import json
-
-            value = stream.read()
-            sample[key] = json.loads(value)
-        elif extension == "npy":
-            import numpy as np
-
-            sample[key] = np.load(stream)
-        elif extension == "mp":
-            import msgpack
-
-            value = stream.read()
-            sample[key] = msgpack.unpackb(value, raw=False)
-        elif extension in ["pt", "pth"]:
-            import torch
-
-            sample[key] = torch.load(stream)
-        elif extension in ["pickle", "pkl"]:
-            import pickle
-
-            sample[key] = pickle.load(stream)
-    return sample
+    return Decoder(format=format, image_size=image_size)(dict(sample))
 
 
 open_itfs = {}
@@ -218,17 +160,34 @@ class IndexedTarSamples:
         *,
         path=None,
         stream=None,
+        reader=None,
         md5sum=None,
         expected_size=None,
         use_mmap=True,
-        index_file=find_index_file,
+        index_file=None,
+        zero_copy=False,
+        cleanup_callback=None,
     ):
-        assert path is not None or stream is not None
+        assert path is not None or stream is not None or reader is not None
+
+        if reader is not None:
+            # an already opened reader, e.g. a RemoteIndexedTar
+            self.path = path
+            self.stream = None
+            self.cleanup_callback = None
+            self.reader = reader
+            self._init_samples(expected_size, zero_copy)
+            return
 
         # Create TarFileReader object to read from tar_file
         self.path = path
         stream = self.stream = stream or open(path, "rb")
 
+        # e.g. keep_while_reading, called with "start" now and "end" on close
+        self.cleanup_callback = cleanup_callback
+        if cleanup_callback is not None:
+            cleanup_callback(stream.name, stream.fileno(), "start")
+
         # verify the MD5 sum
         if md5sum is not None:
             stream.seek(0)
@@ -242,18 +201,34 @@ class IndexedTarSamples:
         # print("convert to gzip IO stream")
         # stream = gzip.GzipFile(fileobj=stream)
 
+        # the sidecar index lives next to the file actually opened, which for
+        # local shards is the original file rather than the cache name
+        if callable(index_file):
+            source = stream.name if isinstance(getattr(stream, "name", None), str) else path
+            index_file = index_file(source) if source is not None else None
+
         if use_mmap:
-            self.reader = MMIndexedTar(stream)
+            self.reader = MMIndexedTar(stream, index_file=index_file)
         else:
             self.reader = TarFileReader(stream, index_file=index_file)
+        self._init_samples(expected_size, zero_copy)
+
+    def _init_samples(self, expected_size, zero_copy):
+        # with zero_copy, samples are MemoryViewIO objects over the mmap (or
+        # the fetched bytes) instead of BytesIO copies, if the reader supports it
+        self.zero_copy = zero_copy and hasattr(self.reader, "get_view")
 
         # Get list of all files in stream
-        all_files = self.reader.names()
+        self.names = self.reader.names()
 
-        # Group files by key into samples
-        self.samples = group_by_key(all_files)
-        # print("DEBUG:", list(all_files)[:20])
-        # print("DEBUG:", self.samples[:20])
+        # Files grouped by key into samples, in CSR layout (see group_members);
+        # the readers compute this once per shard and keep it in the sidecar index
+        groups = self.reader.groups
+        self.sample_order = groups["sample_order"]
+        self.sample_offsets = groups["sample_offsets"]
+        self.sample_key_lengths = groups["sample_key_lengths"]
+        self.member_extensions = groups["member_extensions"]
+        self.extensions = groups["extensions"]
 
         # check that the number of samples is correct
         if expected_size is not None:
@@ -262,27 +237,40 @@ class IndexedTarSamples:
         self.uuid = str(uuid.uuid4())
 
     def close(self):
+        if self.cleanup_callback is not None and not self.stream.closed:
+            self.cleanup_callback(self.stream.name, self.stream.fileno(), "end")
         self.reader.close()
-        if not self.stream.closed:
+        if self.stream is not None and not self.stream.closed:
             self.stream.close()
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.sample_offsets) - 1
+
+    def sample_members(self, idx):
+        """Return the indexes of the files of sample idx, in tar order."""
+        lo, hi = self.sample_offsets[idx : idx + 2].tolist()
+        return self.sample_order[lo:hi]
 
     def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"sample index {idx} out of range for {self}")
         # Get indexes of files for the sample at index idx
-        indexes = self.samples[idx]
+        indexes = self.sample_members(idx).tolist()
+        key = self.names[indexes[0]][: int(self.sample_key_lengths[idx])]
+        if hasattr(self.reader, "load_members"):
+            # remote readers fetch all members of the sample in one go
+            self.reader.load_members(indexes)
         sample = {}
-        key = None
         for i in indexes:
             # Get filename and data for the file at index i
-            fname, data = self.reader.get_file(i)
-            # Split filename into key and extension
-            k, ext = splitname(fname)
-            # Make sure all files in sample have same key
-            key = key or k
-            assert key == k
-            sample[ext] = data
+            if self.zero_copy:
+                fname, data = self.reader.get_view(i)
+                data = MemoryViewIO(data)
+            else:
+                fname, data = self.reader.get_file(i)
+            sample[self.extensions[self.member_extensions[i]]] = data
         # Add key to sample
         sample["__key__"] = key
         return sample
@@ -296,11 +284,8 @@ class IndexedTarSamples:
 
 def hash_localname(dldir="/tmp/_wids_cache"):
     os.makedirs(dldir, exist_ok=True)
-
-    connection = sqlite3.connect(os.path.join(dldir, "cache.db"))
-    cursor = connection.cursor()
-    cursor.execute("CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)")
-    connection.commit()
+    # urls are recorded in the cache index, in batches
+    index = cache_index(dldir)
 
     def f(shard):
         """Given a URL, return a local name for the shard."""
@@ -314,12 +299,7 @@ def hash_localname(dldir="/tmp/_wids_cache"):
             hex16 = base64.urlsafe_b64encode(hashlib.sha256(dirname.encode()).digest())[:16].decode()
             # the cache name is the concatenation of the hex16 string and the file name component of the URL
             cachename = "data__" + hex16 + "__" + os.path.basename(urlparse(shard).path)
-            checksum = None
-            cursor.execute(
-                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
-                (shard, cachename, checksum),
-            )
-            connection.commit()
+            index.record_url(shard, cachename)
             return os.path.join(dldir, cachename)
 
     return f
@@ -356,10 +336,36 @@ class LRUShards:
     The local name of a shard is computed by the localname function, which
     takes the shard URL as an argument. If keep is True, the downloaded files
     are not deleted when they are no longer needed.
+
+    Downloaded shards are share-locked while they are open, so that neither
+    other processes releasing them nor `disk_cache` (a `ShardDiskCache`
+    enforcing a byte budget on the download directory) delete them while
+    they are in use.
+
+    With `range_reads`, http(s) shards are not downloaded; their members are
+    fetched with Range requests by a `RemoteIndexedTar`, and only the sidecar
+    index, if `index_file` is given, is stored locally (under the local name
+    of the shard).
     """
 
-    def __init__(self, lru_size, keep=False, localname=default_localname()):
+    def __init__(
+        self,
+        lru_size,
+        keep=False,
+        localname=default_localname(),
+        index_file=None,
+        zero_copy=False,
+        disk_cache=None,
+        prefetcher=None,
+        range_reads=False,
+    ):
         self.localname = localname
+        self.range_reads = range_reads
+        self.keep = keep
+        self.index_file = index_file
+        self.zero_copy = zero_copy
+        self.disk_cache = disk_cache
+        self.prefetcher = prefetcher
         # the cache contains the local name as the key and the downloaded path as the value
         self.lru = LRUCache(lru_size, release_handler=self.release_handler)
         # keep statistics
@@ -368,12 +374,20 @@ class LRUShards:
     def reset_stats(self):
         self.accesses = 0
         self.misses = 0
+        # on misses: shard already on local disk / downloaded synchronously /
+        # waited for a download in progress (e.g. a prefetch)
+        self.disk_hits = 0
+        self.downloads = 0
+        self.stalls = 0
+        self.stall_time = 0.0
 
     def __len__(self):
         return len(self.lru)
 
     def release_handler(self, key, value):
         value.close()
+        if self.disk_cache is not None and value.cleanup_callback is not None:
+            self.disk_cache.unpin(value.path)
 
     def clear(self):
         self.lru.clear()
@@ -381,11 +395,47 @@ class LRUShards:
     def get_shard(self, url):
         assert isinstance(url, str)
         self.accesses += 1
-        if url not in self.lru:
+        if url not in self.lru and self.range_reads and url.startswith(("http://", "https://")):
+            index_file = self.index_file
+            if callable(index_file):
+                index_file = index_file(self.localname(url))
+            reader = RemoteIndexedTar(url, index_file=index_file)
+            self.lru[url] = IndexedTarSamples(path=url, reader=reader, zero_copy=self.zero_copy)
+            self.misses += 1
+            self.last_missed = True
+        elif url not in self.lru:
             local = self.localname(url)
-            with download_and_open(url, local) as stream:
-                itf = IndexedTarSamples(path=local, stream=stream)
+            start = time.time()
+            in_flight = os.path.exists(local + ".lock")
+            present = os.path.exists(url) or os.path.exists(local)
+            if self.prefetcher is not None and self.prefetcher.wait(url):
+                in_flight = True
+            stream = download_and_open(url, local)
+            if in_flight:
+                self.stalls += 1
+                self.stall_time += time.time() - start
+            elif present:
+                self.disk_hits += 1
+            else:
+                self.downloads += 1
+            # local files are opened in place; only downloaded copies are managed
+            downloaded = stream.name != url
+            try:
+                itf = IndexedTarSamples(
+                    path=local,
+                    stream=stream,
+                    index_file=self.index_file,
+                    zero_copy=self.zero_copy,
+                    cleanup_callback=(pin_while_reading if self.keep else keep_while_reading) if downloaded else None,
+                )
+            except BaseException:
+                stream.close()
+                raise
+            # insert first, so that the shard this pushes out of the LRU can be evicted
             self.lru[url] = itf
+            if downloaded and self.disk_cache is not None:
+                self.disk_cache.pin(local)
+                self.disk_cache.enforce()
             self.misses += 1
             self.last_missed = True
         else:
@@ -397,7 +447,8 @@ def interpret_transformations(transformations):
     """Interpret the transformations argument.
 
     This takes care of transformations specified as string shortcuts
-    and returns a list of callables.
+    and returns a list of callables. A `wids_decode.Decoder` can be passed
+    to decode only some fields or to decode with a thread pool.
     """
     if not isinstance(transformations, list):
         transformations = [transformations]
@@ -406,9 +457,9 @@ def interpret_transformations(transformations):
 
     for transformation in transformations:
         if transformation == "PIL":
-            transformation = partial(default_decoder, format="PIL")
+            transformation = Decoder(format="PIL")
         elif transformation == "numpy":
-            transformation = partial(default_decoder, format="numpy")
+            transformation = Decoder(format="numpy")
         else:
             assert callable(transformation)
         result.append(transformation)
@@ -416,6 +467,11 @@ def interpret_transformations(transformations):
     return result
 
 
+CacheStats = collections.namedtuple(
+    "CacheStats", ["accesses", "misses", "disk_hits", "downloads", "stalls", "stall_time"]
+)
+
+
 def hash_dataset_name(input_string):
     """Compute a hash of the input string and return the first 16 characters of the hash."""
     # Compute SHA256 hash of the input string
@@ -457,28 +513,55 @@ class ShardListDataset(Dataset[T]):
         base=None,
         options=None,
         verbose=False,
+        index_file=None,
+        zero_copy=False,
+        prefetch=0,
+        prefetch_workers=2,
+        prefetch_bytes=None,
+        range_reads=False,
+        length_cache=None,
     ):
         """Create a ShardListDataset.
 
         Args:
             shards: a list of (filename, length) pairs or a URL pointing to a JSON descriptor file,
                     or you can input filenames directly, dataset will generate the length automatically.
-            cache_size: the number of shards to keep in the cache
+            cache_size: the maximum number of bytes of downloaded shards to keep in the cache
+                    directory; least recently used shards are deleted beyond that
+            keep: keep downloaded shards after they are closed (up to cache_size); otherwise
+                    they are deleted once no process has them open
             lru_size: the number of shards to keep in the LRU cache
             localname: a function that maps URLs to local filenames
+            index_file: a function that maps shard paths to sidecar index files, so that
+                    reopening a shard does not rescan its tar headers; None (the default)
+                    rescans them and writes no files. `find_index_file` keeps persistent
+                    indexes next to the shards (or in the wids cache if their directory is
+                    read-only), `shm_index_file` keeps them in /dev/shm, shared by all
+                    workers and ranks of a node and deleted once no process has the shard open
+            zero_copy: return sample files as read-only views of the mmapped shard instead
+                    of BytesIO copies; decoded .npy arrays are then read-only as well
+            prefetch: number of shards to download and index ahead of the one being read,
+                    following the order of a ShardListSampler/ChunkedSampler over this dataset
+            prefetch_workers: number of concurrent prefetch downloads
+            prefetch_bytes: limit on the total filesize of the shards being prefetched ahead
+            range_reads: read http(s) shards with HTTP Range requests instead of downloading
+                    them (see `wids_remote`); the server must support Range requests, and a
+                    sidecar index published next to each shard avoids scanning it remotely.
+                    This disables `prefetch`.
+            length_cache: when shards are given as bare filenames, a JSON file in which their
+                    sample counts are cached, keyed by the list of filenames; the counts are
+                    otherwise computed by all ranks together on every start
 
         Note that there are two caches: an on-disk directory, and an in-memory LRU cache.
         """
         if isinstance(shards, List) and isinstance(shards[0], str):
-            # only filenames are given, we need to compute the length
-            _shards = {}
+            # only filenames are given, we need to compute the length; all ranks
+            # share the work
             if is_main_process():
-                # only compute it once on the main process
                 logger.info("Shard lengths not provided, indexing shards...")
-                _shards = get_file_lengths(shards)
+            shards = get_file_lengths_distributed(shards, cache_file=length_cache)
+            if is_main_process():
                 logger.info("Indexing complete")
-            _shards_gathered = all_gather_object(_shards)
-            shards = _shards_gathered[0]  # broadcast the result to all processes
 
         if options is None:
             options = {}
@@ -513,7 +596,12 @@ class ShardListDataset(Dataset[T]):
             self.shards = shards
             self.dataset_name = dataset_name or hash_dataset_name(str(shards))
 
-        self.lengths = [shard["nsamples"] for shard in self.shards]
+        # resolve all urls once and keep the shard list in compact form; the
+        # spec refers to the table so that the descriptor dicts can be freed
+        self.shards = ShardTable(self.shards, resolve=self.resolve_url)
+        self.spec["shardlist"] = self.shards
+
+        self.lengths = self.shards.nsamples
         self.cum_lengths = np.cumsum(self.lengths)
         self.total_length = self.cum_lengths[-1]
 
@@ -535,8 +623,8 @@ class ShardListDataset(Dataset[T]):
             self.localname = default_localname(self.cache_dir)
 
         if verbose or int(os.environ.get("WIDS_VERBOSE", 0)):
-            nbytes = sum(shard.get("filesize", 0) for shard in self.shards)
-            nsamples = sum(shard["nsamples"] for shard in self.shards)
+            nbytes = int(np.maximum(self.shards.filesize, 0).sum())
+            nsamples = int(self.shards.nsamples.sum())
 
             logger.info(
                 "\t".join(
@@ -556,7 +644,20 @@ class ShardListDataset(Dataset[T]):
 
         if lru_size > 200:
             warnings.warn("LRU size is very large; consider reducing it to avoid running out of file descriptors")
-        self.cache = LRUShards(lru_size, localname=self.localname, keep=keep)
+        self.disk_cache = ShardDiskCache(self.cache_dir, cache_size) if self.cache_dir is not None else None
+        self.prefetcher = None
+        if prefetch > 0 and not range_reads:
+            self.prefetcher = ShardPrefetcher(self, depth=prefetch, num_workers=prefetch_workers, max_bytes=prefetch_bytes)
+        self.cache = LRUShards(
+            lru_size,
+            localname=self.localname,
+            keep=keep,
+            index_file=index_file,
+            zero_copy=zero_copy,
+            disk_cache=self.disk_cache,
+            prefetcher=self.prefetcher,
+            range_reads=range_reads,
+        )
 
     def add_transform(self, transform):
         """Add a transformation to the dataset."""
@@ -571,6 +672,19 @@ class ShardListDataset(Dataset[T]):
         """Return the number of cache accesses and misses."""
         return self.cache.accesses, self.cache.misses
 
+    def get_cache_stats(self):
+        """Return the shard cache statistics of this process.
+
+        `accesses` and `misses` count lookups in the in-memory LRU. Each miss is
+        either a `disk_hit` (the shard was already downloaded, e.g. prefetched),
+        a `download` done synchronously, or a `stall` waiting for a download in
+        progress; `stall_time` is the total time spent stalled.
+        """
+        cache = self.cache
+        return CacheStats(
+            cache.accesses, cache.misses, cache.disk_hits, cache.downloads, cache.stalls, cache.stall_time
+        )
+
     def check_cache_misses(self):
         """Check if the cache miss rate is too high."""
         accesses, misses = self.get_stats()
@@ -579,8 +693,28 @@ class ShardListDataset(Dataset[T]):
             self.check_cache_misses = lambda: None
             logger.warning("Warning: ShardListDataset has a cache miss rate of {:.1%}%".format(misses * 100.0 / accesses))
 
+    def resolve_url(self, url):
+        """Resolve a shard url from the shard list, making relative paths absolute against the base."""
+        if url.startswith(("https://", "http://", "gs://", "/", "~")):
+            # absolute path or url path
+            return url
+        # concat relative path
+        if self.base is None and "base_path" not in self.spec:
+            raise FileNotFoundError("passing a relative path in shardlist but no base found.")
+        base_path = self.spec["base_path"] if "base_path" in self.spec else self.base
+        return osp.abspath(osp.join(osp.expanduser(base_path), url))
+
+    def get_shard_url(self, shard_idx):
+        """Return the resolved URL of a shard."""
+        return self.shards.url(shard_idx)
+
     def get_shard(self, index):
         """Get the shard and index within the shard corresponding to the given index."""
+        shard, inner_idx, shard_idx = self._get_shard(index)
+        return shard, inner_idx, self.shards[shard_idx]
+
+    def _get_shard(self, index):
+        """Like `get_shard`, but return the shard number instead of its descriptor."""
         # Find the shard corresponding to the given index.
         shard_idx = np.searchsorted(self.cum_lengths, index, side="right")
 
@@ -592,37 +726,25 @@ class ShardListDataset(Dataset[T]):
             inner_idx = index - self.cum_lengths[shard_idx - 1]
 
         # Get the shard and return the corresponding element.
-        desc = self.shards[shard_idx]
-        url = desc["url"]
-        if url.startswith(("https://", "http://", "gs://", "/", "~")):
-            # absolute path or url path
-            url = url
-        else:
-            # concat relative path
-            if self.base is None and "base_path" not in self.spec:
-                raise FileNotFoundError("passing a relative path in shardlist but no base found.")
-            base_path = self.spec["base_path"] if "base_path" in self.spec else self.base
-            url = osp.abspath(osp.join(osp.expanduser(base_path), url))
-
-        desc["url"] = url
+        url = self.get_shard_url(shard_idx)
         try:
             shard = self.cache.get_shard(url)
         except UnicodeDecodeError as e:
-            logger.error("UnicodeDecodeError:", desc)
+            logger.error("UnicodeDecodeError:", url)
             raise e
-        return shard, inner_idx, desc
+        return shard, inner_idx, shard_idx
 
     def __getitem__(self, index):
         """Return the sample corresponding to the given index."""
-        shard, inner_idx, desc = self.get_shard(index)
+        shard, inner_idx, shard_idx = self._get_shard(index)
         sample = shard[inner_idx]
 
         # Check if we're missing the cache too often.
         self.check_cache_misses()
 
-        sample["__dataset__"] = desc.get("dataset")
+        sample["__dataset__"] = self.shards.get(shard_idx, "dataset")
         sample["__index__"] = index
-        sample["__shard__"] = desc["url"]
+        sample["__shard__"] = self.shards.url(shard_idx)
         sample["__shardindex__"] = inner_idx
 
         # Apply transformations
@@ -631,9 +753,60 @@ class ShardListDataset(Dataset[T]):
 
         return sample
 
+    def __getitems__(self, indices):
+        """Return the samples for a batch of indices, in the given order.
+
+        This is used by torch DataLoaders with batch samplers. The indices are
+        mapped to shards with one vectorized searchsorted, and each shard is
+        looked up once and read in offset order (samples are stored in order
+        of their index within a shard), which keeps I/O sequential.
+        """
+        indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+        if len(indices) == 0:
+            return []
+        if (indices.min() < 0 or indices.max() >= self.total_length):
+            raise IndexError(f"sample index out of range for dataset of length {self.total_length}")
+        shard_idxs = np.searchsorted(self.cum_lengths, indices, side="right")
+        shard_starts = np.concatenate([[0], self.cum_lengths[:-1]])
+        inner_idxs = indices - shard_starts[shard_idxs]
+
+        samples = [None] * len(indices)
+        # positions in the batch, grouped by shard and sorted by inner index
+        order = np.lexsort((inner_idxs, shard_idxs))
+        bounds = np.flatnonzero(np.diff(shard_idxs[order])) + 1
+        for group in np.split(order, bounds):
+            shard_idx = int(shard_idxs[group[0]])
+            url = self.get_shard_url(shard_idx)
+            dataset = self.shards.get(shard_idx, "dataset")
+            shard = self.cache.get_shard(url)
+            inner = inner_idxs[group].tolist()
+            if hasattr(shard.reader, "load_members"):
+                # remote readers fetch the members of all samples together
+                shard.reader.load_members(np.concatenate([shard.sample_members(i) for i in inner]))
+            for pos, inner_idx in zip(group.tolist(), inner):
+                sample = shard[inner_idx]
+                sample["__dataset__"] = dataset
+                sample["__index__"] = int(indices[pos])
+                sample["__shard__"] = url
+                sample["__shardindex__"] = inner_idx
+                samples[pos] = sample
+            self.check_cache_misses()
+
+        # transformations that can, like a Decoder, process the whole batch at once
+        for transform in self.transformations:
+            if hasattr(transform, "apply_batch"):
+                samples = transform.apply_batch(samples)
+            else:
+                samples = [transform(sample) for sample in samples]
+        return samples
+
     def close(self):
         """Close the dataset."""
+        if self.prefetcher is not None:
+            self.prefetcher.close()
         self.cache.clear()
+        if self.disk_cache is not None:
+            self.disk_cache.close()
 
 
 def lengths_to_ranges(lengths):
@@ -664,23 +837,90 @@ def intersect_ranges(rangelist, r):
     return result
 
 
-def iterate_ranges(ranges, rng, indexshuffle=True, shardshuffle=True, total_size=None):
-    """Iterate over the ranges in a random order."""
+def iterate_ranges(ranges, rng, indexshuffle=True, shardshuffle=True, total_size=None, lookahead=None, start=0, blocksize=65536):
+    """Iterate over the ranges in a random order.
+
+    If given, `lookahead` is called before each range with an iterator over
+    the ranges still to come, starting with the one about to be iterated.
+
+    Each range is shuffled with its own numpy generator seeded from `rng`, so
+    that iteration can begin at any `start` position of the sequence without
+    generating the indexes before it. Indexes are generated as numpy arrays
+    and handed out `blocksize` at a time.
+    """
     shard_indexes = list(range(len(ranges)))
     if shardshuffle:
         rng.shuffle(shard_indexes)
-    for i in shard_indexes:
+    base_seed = rng.getrandbits(64)
+    skip = start
+    for k, i in enumerate(shard_indexes):
         lo, hi = ranges[i]
-        sample_indexes = list(range(lo, hi))
+        if skip >= hi - lo:
+            skip -= hi - lo
+            continue
+        if lookahead is not None:
+            lookahead(ranges[j] for j in shard_indexes[k:])
+        if indexshuffle:
+            sample_indexes = lo + np.random.default_rng([base_seed, i]).permutation(hi - lo)
+        else:
+            sample_indexes = np.arange(lo, hi)
         if total_size is not None:
             # to support drop_last=True
-            sample_indexes = [_ if _ < total_size else (_ % total_size) for _ in sample_indexes]
-        if indexshuffle:
-            rng.shuffle(sample_indexes)
-        yield from sample_indexes
+            sample_indexes = np.where(sample_indexes < total_size, sample_indexes, sample_indexes % total_size)
+        for block in range(skip, len(sample_indexes), blocksize):
+            yield from sample_indexes[block : block + blocksize].tolist()
+        skip = 0
+
+
+class SamplerStateMixin:
+    """Checkpointing of the position of a sampler within an epoch.
+
+    Samplers using this count the indexes they hand out in `self.position`
+    and start their next iteration at `self.position` after
+    `load_state_dict`, without generating the skipped indexes. Any other
+    iteration starts at the beginning of the epoch, also after an iteration
+    that was abandoned midway.
+
+    Note that DataLoaders request indexes ahead of the training loop (up to
+    `prefetch_factor * num_workers` batches), so `position` in a state dict
+    taken during training is ahead of the samples actually consumed. For an
+    exact resume, store the number of consumed samples as `position`.
+    """
+
+    position = 0
+    _resume = False
+
+    def state_dict(self):
+        return dict(epoch=self.epoch, seed=self.seed, position=self.position)
+
+    def load_state_dict(self, state):
+        self.epoch = state["epoch"]
+        self.seed = state["seed"]
+        self.position = state["position"]
+        self._resume = True
+
+    def _start(self):
+        """Return the position the iteration being started begins at."""
+        if not self._resume:
+            self.position = 0
+        self._resume = False
+        return self.position
+
+    def _count(self, indexes):
+        for index in indexes:
+            self.position += 1
+            yield index
+        self.position = 0
+        self.epoch += 1
+
+
+def prefetch_hook(dataset):
+    """Return the lookahead callback for iterate_ranges if the dataset prefetches shards."""
+    prefetcher = getattr(dataset, "prefetcher", None)
+    return prefetcher.update if prefetcher is not None else None
 
 
-class ShardListSampler(Sampler):
+class ShardListSampler(SamplerStateMixin, Sampler):
     """A sampler that samples consistent with a ShardListDataset.
 
     This sampler is used to sample from a ShardListDataset in a way that
@@ -701,6 +941,7 @@ class ShardListSampler(Sampler):
     def __init__(self, dataset, *, lengths=None, seed=0, shufflefirst=False):
         if lengths is None:
             lengths = list(dataset.lengths)
+        self.dataset = dataset
         self.ranges = lengths_to_ranges(lengths)
         self.seed = seed
         self.shufflefirst = shufflefirst
@@ -709,14 +950,97 @@ class ShardListSampler(Sampler):
     def __iter__(self):
         self.rng = random.Random(self.seed + 1289738273 * self.epoch)
         shardshuffle = self.shufflefirst or self.epoch > 0
-        yield from iterate_ranges(self.ranges, self.rng, shardshuffle=shardshuffle)
-        self.epoch += 1
+        indexes = iterate_ranges(
+            self.ranges, self.rng, shardshuffle=shardshuffle, lookahead=prefetch_hook(self.dataset), start=self._start()
+        )
+        return self._count(indexes)
 
 
 ShardedSampler = ShardListSampler
 
 
-class ChunkedSampler(Sampler):
+class ShardWindowSampler(Sampler):
+    """A sampler that mixes samples from a sliding window of open shards.
+
+    Shards are visited in a random order. At any time, samples are drawn at
+    random from the `window` shards currently open (weighted by the number
+    of samples they have left); when a shard is used up, the next one takes
+    its place. So no more than `window` distinct shards are live at once,
+    while samples are mixed across `window` shards instead of one.
+
+    By default `window` is the `lru_size` of the dataset. The in-memory LRU
+    then never has to drop a live shard: before a new shard is opened, every
+    live shard is read again by each DataLoader worker, so that the shard
+    that was used up is the least recently used entry of every worker's
+    cache. For this, `num_workers` and `batch_size` must match the
+    DataLoader. Each shard is then opened once per worker and epoch.
+
+    Args:
+        dataset: a ShardListDataset
+        window: number of shards to mix (dataset.cache.lru.capacity by default)
+        lengths: shard lengths (dataset.lengths by default)
+        num_workers: number of DataLoader workers (0 counts as 1)
+        batch_size: DataLoader batch size
+        seed: random seed
+    """
+
+    def __init__(self, dataset, *, window=None, lengths=None, num_workers=0, batch_size=1, seed=0):
+        if window is None:
+            window = dataset.cache.lru.capacity
+        if lengths is None:
+            lengths = list(dataset.lengths)
+        assert window >= 1
+        self.dataset = dataset
+        self.window = window
+        self.ranges = lengths_to_ranges(lengths)
+        self.num_workers = max(num_workers, 1)
+        self.batch_size = batch_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return sum(hi - lo for lo, hi in self.ranges)
+
+    def __iter__(self):
+        rng = random.Random(self.seed + 1289738273 * self.epoch)
+        self.epoch += 1
+        todo = list(range(len(self.ranges)))
+        rng.shuffle(todo)
+        todo.reverse()
+        # live shards, their shuffled sample indexes still to be drawn, and
+        # per worker the live shards not read since a shard was used up
+        live, left = [], {}
+        stale = [set() for _ in range(self.num_workers)]
+        position = 0
+        while todo or live:
+            while todo and len(live) < self.window and not any(stale):
+                shard = todo.pop()
+                lo, hi = self.ranges[shard]
+                if hi > lo:
+                    left[shard] = list(range(lo, hi))
+                    rng.shuffle(left[shard])
+                    live.append(shard)
+            if not live:
+                break
+            worker = (position // self.batch_size) % self.num_workers
+            if stale[worker]:
+                shard = rng.choice(sorted(stale[worker]))
+            else:
+                shard = rng.choices(live, weights=[len(left[k]) for k in live])[0]
+            yield left[shard].pop()
+            position += 1
+            stale[worker].discard(shard)
+            if not left[shard]:
+                live.remove(shard)
+                del left[shard]
+                if todo:
+                    stale = [set(live) for _ in range(self.num_workers)]
+
+
+class ChunkedSampler(SamplerStateMixin, Sampler):
     """A sampler that samples in chunks and then shuffles the samples within each chunk.
 
     This preserves locality of reference while still shuffling the data.
@@ -739,6 +1063,7 @@ class ChunkedSampler(Sampler):
         else:
             lo, hi = num_samples
         self._len = hi - lo
+        self.dataset = dataset
         self.ranges = [(i, min(i + chunksize, hi)) for i in range(lo, hi, chunksize)]
         self.dataset_size = len(dataset)
         self.seed = seed
@@ -752,14 +1077,16 @@ class ChunkedSampler(Sampler):
     def __iter__(self):
         self.rng = random.Random(self.seed + 1289738273 * self.epoch)
         shardshuffle = self.shufflefirst or self.epoch > 0
-        yield from iterate_ranges(
+        indexes = iterate_ranges(
             self.ranges,
             self.rng,
             indexshuffle=self.shuffle,
             shardshuffle=(self.shuffle and shardshuffle),
             total_size=self.dataset_size,
+            lookahead=prefetch_hook(self.dataset),
+            start=self._start(),
         )
-        self.epoch += 1
+        return self._count(indexes)
 
     def __len__(self):
         return self._len
@@ -826,6 +1153,291 @@ def DistributedChunkedSampler(
     )
 
 
+def resolve_replicas(num_replicas=None, rank=None):
+    """Return (num_replicas, rank), defaulting to the torch.distributed world."""
+    if not dist.is_initialized():
+        num_replicas = num_replicas or 1
+        rank = rank or 0
+    else:
+        num_replicas = num_replicas or dist.get_world_size()
+        rank = dist.get_rank() if rank is None else rank
+    assert 0 <= rank < num_replicas
+    return num_replicas, rank
+
+
+def partition_shards(lengths, nbins, order=None, rng=None):
+    """Assign shards to `nbins` bins with balanced sample counts.
+
+    This is greedy bin packing: shards are taken longest first (ties in the
+    given `order`) and each goes to the bin with the fewest samples so far.
+    With a numpy Generator `rng`, each shard instead goes to a random bin
+    among those holding at most the length of the shard more than the
+    lightest one, so that the packing differs from one `rng` to the next
+    while the bins still end up within about twice the longest shard of
+    each other. Shards without samples are left out, so a bin can end up
+    empty if there are fewer nonempty shards than bins. Returns a list of
+    lists of shard indexes.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.arange(len(lengths)) if order is None else np.asarray(order)
+    order = order[lengths[order] > 0]
+    by_size = order[np.argsort(-lengths[order], kind="stable")]
+    bins = [[] for _ in range(nbins)]
+    if rng is not None:
+        totals = np.zeros(nbins, dtype=np.int64)
+        for shard in by_size.tolist():
+            n = int(lengths[shard])
+            candidates = np.flatnonzero(totals <= totals.min() + n)
+            b = int(candidates[rng.integers(len(candidates))])
+            bins[b].append(shard)
+            totals[b] += n
+        return bins
+    heap = [(0, b) for b in range(nbins)]
+    for shard in by_size.tolist():
+        total, b = heapq.heappop(heap)
+        bins[b].append(shard)
+        heapq.heappush(heap, (total + int(lengths[shard]), b))
+    return bins
+
+
+class DistributedShardSampler(SamplerStateMixin, Sampler):
+    """A sampler that assigns whole shards to (rank, DataLoader worker) pairs.
+
+    Every epoch, the shards are packed into `num_replicas * num_workers` bins
+    of (nearly) equal sample counts with `partition_shards`, choosing
+    randomly among the bins that keep the packing balanced, so the
+    assignment of shards to ranks and workers changes from epoch to epoch
+    (unless `shuffle` is off). Each
+    rank iterates over its own bins, shard by shard, shuffling samples
+    within shards.
+
+    The DataLoader hands out batches to its workers round robin, so the
+    sampler interleaves its bins batch by batch: worker w receives all the
+    batches of bin w and never opens a shard owned by another worker or rank.
+    For this, `batch_size` and `num_workers` must match the DataLoader.
+
+    All bins are cut (`drop_last`) or padded with their own samples to the
+    same multiple of `batch_size`, so every rank has the same length. A bin
+    left empty (when there are fewer nonempty shards than bins) is filled
+    with the samples of the largest bin.
+
+    Args:
+        dataset: a ShardListDataset
+        num_replicas: number of ranks (world size by default)
+        rank: rank of this process
+        num_workers: number of DataLoader workers per rank (0 counts as 1)
+        batch_size: DataLoader batch size
+        lengths: shard lengths (dataset.lengths by default)
+        shuffle: shuffle shards and samples within shards
+        seed: random seed, must be the same on all ranks
+        drop_last: cut bins to the shortest one instead of padding them to the longest
+    """
+
+    def __init__(
+        self,
+        dataset,
+        *,
+        num_replicas=None,
+        rank=None,
+        num_workers=0,
+        batch_size=1,
+        lengths=None,
+        shuffle=True,
+        seed=0,
+        drop_last=False,
+    ):
+        num_replicas, rank = resolve_replicas(num_replicas, rank)
+        self.dataset = dataset
+        self.lengths = np.asarray(dataset.lengths if lengths is None else lengths, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_workers = max(num_workers, 1)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        nbins = self.num_replicas * self.num_workers
+        if len(self.lengths) < nbins:
+            raise ValueError(f"{len(self.lengths)} shards cannot be split among {nbins} ranks and workers")
+        # the bin sizes depend on the assignment, which changes every epoch
+        self._bins = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def assignment(self):
+        """Return the shard bins of all ranks and workers for the current epoch."""
+        if self._bins is None or self._bins[0] != self.epoch:
+            rng = np.random.default_rng([self.seed, self.epoch])
+            nbins = self.num_replicas * self.num_workers
+            if self.shuffle:
+                bins = partition_shards(self.lengths, nbins, rng.permutation(len(self.lengths)), rng=rng)
+            else:
+                bins = partition_shards(self.lengths, nbins)
+            self._bins = (self.epoch, bins)
+        return self._bins[1]
+
+    def bin_size(self):
+        """Return the number of samples every bin is cut or padded to."""
+        totals = [int(self.lengths[b].sum()) for b in self.assignment()]
+        bs = self.batch_size
+        if self.drop_last:
+            # empty bins are filled from the others, so they don't cut the rest
+            return min([total for total in totals if total > 0] or [0]) // bs * bs
+        return (max(totals) + bs - 1) // bs * bs
+
+    def __len__(self):
+        return self.num_workers * self.bin_size()
+
+    def __iter__(self):
+        bins = self.assignment()
+        size = self.bin_size()
+        rng = np.random.default_rng([self.seed, self.epoch, self.rank])
+        largest = max(bins, key=lambda b: int(self.lengths[b].sum()))
+        streams = []
+        for b in bins[self.rank * self.num_workers : (self.rank + 1) * self.num_workers]:
+            # an empty bin takes the samples of the largest one
+            shards = b or largest
+            shards = rng.permutation(shards) if self.shuffle else shards
+            parts = []
+            for shard in shards:
+                n = int(self.lengths[shard])
+                parts.append(self.starts[shard] + (rng.permutation(n) if self.shuffle else np.arange(n)))
+            indices = np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+            streams.append(np.resize(indices, size) if len(indices) > 0 else indices)
+        # batch k of the DataLoader goes to worker k % num_workers
+        batches = np.stack(streams).reshape(self.num_workers, -1, self.batch_size).transpose(1, 0, 2)
+        return self._count(batches.reshape(-1)[self._start() :].tolist())
+
+
+def shard_source(desc):
+    """Return the name of the (sub-)dataset a shard descriptor belongs to."""
+    return desc.get("dataset") or desc.get("name") or ""
+
+
+def apportion(total, ratios):
+    """Split `total` into integers proportional to `ratios` (largest remainder)."""
+    quotas = total * np.asarray(ratios, dtype=np.float64) / np.sum(ratios)
+    counts = np.floor(quotas).astype(np.int64)
+    extra = np.argsort(counts - quotas, kind="stable")[: total - counts.sum()]
+    counts[extra] += 1
+    return counts
+
+
+class WeightedShardSampler(SamplerStateMixin, Sampler):
+    """A sampler that mixes the sub-datasets of a ShardListDataset by weight.
+
+    Shards are grouped into sources by their `dataset` field (or `name` for
+    shards listed directly in the descriptor), and each source contributes
+    `weight / sum(weights)` of the samples of an epoch, using the `weight`
+    that `resolve_dsdesc` puts on its shards (1.0 if missing). A source that
+    is asked for more samples than it has is upsampled by visiting its
+    shards more than once; one asked for fewer is downsampled by visiting a
+    random subset of its shards (the last one partially).
+
+    Every epoch, the shard visits of all sources are shuffled and read one
+    after the other, with samples shuffled within each visit, which keeps
+    shard locality. In distributed training, each rank takes a contiguous
+    part of this sequence, padded by wrapping around (or cut with
+    `drop_last`) to the same length on all ranks.
+
+    Args:
+        dataset: a ShardListDataset
+        num_samples: samples per epoch over all ranks (len(dataset) by default)
+        weights: dict overriding the weights of sources by name
+        num_replicas, rank: distributed setup (from torch.distributed by default)
+        seed: random seed, must be the same on all ranks
+        drop_last: cut instead of pad the per-rank sequences
+    """
+
+    def __init__(self, dataset, *, num_samples=None, weights=None, num_replicas=None, rank=None, seed=0, drop_last=False):
+        self.num_replicas, self.rank = resolve_replicas(num_replicas, rank)
+        self.dataset = dataset
+        self.lengths = np.asarray(dataset.lengths, dtype=np.int64)
+        self.starts = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+        names = [shard_source(shard) for shard in dataset.shards]
+        self.sources = list(dict.fromkeys(names))
+        self.source_ids = np.array([self.sources.index(name) for name in names], dtype=np.int64)
+        weights = dict(weights or {})
+        for shard, name in zip(dataset.shards, names):
+            weight = shard.get("weight")
+            weights.setdefault(name, 1.0 if weight is None else weight)
+        self.weights = np.array([weights[name] for name in self.sources], dtype=np.float64)
+        self.total = int(self.lengths.sum() if num_samples is None else num_samples)
+        self.source_samples = apportion(self.total, self.weights)
+        sizes = np.bincount(self.source_ids, weights=self.lengths, minlength=len(self.sources))
+        for name, size, count in zip(self.sources, sizes, self.source_samples):
+            if count > 0 and size == 0:
+                raise ValueError(f"source {name!r} has weight but no samples")
+        if drop_last:
+            self.num_samples = self.total // self.num_replicas
+        else:
+            self.num_samples = (self.total + self.num_replicas - 1) // self.num_replicas
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def visits(self):
+        """Return the shards visited in the current epoch and the samples taken from each."""
+        rng = np.random.default_rng([self.seed, self.epoch])
+        shards, takes = [], []
+        for source, count in enumerate(self.source_samples.tolist()):
+            members = np.flatnonzero(self.source_ids == source)
+            members = members[self.lengths[members] > 0]
+            size = int(self.lengths[members].sum())
+            if count == 0:
+                continue
+            passes, rest = divmod(count, size)
+            for _ in range(passes):
+                shards.append(members)
+                takes.append(self.lengths[members])
+            if rest > 0:
+                members = rng.permutation(members)
+                ends = np.cumsum(self.lengths[members])
+                last = int(np.searchsorted(ends, rest))
+                members = members[: last + 1]
+                take = self.lengths[members].copy()
+                take[-1] -= ends[last] - rest
+                shards.append(members)
+                takes.append(take)
+        shards, takes = np.concatenate(shards), np.concatenate(takes)
+        order = rng.permutation(len(shards))
+        return shards[order], takes[order]
+
+    def _visit(self, k, shard, take):
+        rng = np.random.default_rng([self.seed, self.epoch, k])
+        return self.starts[shard] + rng.permutation(int(self.lengths[shard]))[:take]
+
+    def _segment(self, shards, takes, ends, lo, hi):
+        first = int(np.searchsorted(ends, lo, side="right"))
+        for k in range(first, len(shards)):
+            begin = int(ends[k] - takes[k])
+            if begin >= hi:
+                break
+            indexes = self._visit(k, int(shards[k]), int(takes[k]))
+            yield from indexes[max(lo - begin, 0) : hi - begin].tolist()
+
+    def __iter__(self):
+        shards, takes = self.visits()
+        ends = np.cumsum(takes)
+        lo = self.rank * self.num_samples + self._start()
+        hi = (self.rank + 1) * self.num_samples
+
+        def indexes():
+            # positions past the end of the epoch wrap around
+            for start in range(lo - lo % self.total, hi, self.total):
+                yield from self._segment(shards, takes, ends, max(lo, start) - start, min(hi, start + self.total) - start)
+
+        return self._count(indexes())
+
+
 import torch, math
 from torch.utils.data.distributed import DistributedSampler
 
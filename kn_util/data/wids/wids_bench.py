@@ -1,8 +1,100 @@
+"""
+Benchmarks for wids.
+
+The `index` and `read` commands take tar shards as arguments. To benchmark
+without a real dataset, generate a synthetic shard first, e.g.
+
+    python -m kn_util.data.wids.wids_bench synth /tmp/bench.tar --samples 100000
+    python -m kn_util.data.wids.wids_bench index /tmp/bench.tar
+
+The `cache` command generates its shards in a temporary directory. Generated
+shards are not meant to be kept in the source tree.
+"""
+
 import argparse
+import http.server
+import io
 import json
+import mmap
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from functools import partial
+
+import numpy as np
 
 from . import wids
-from .compat import WebDataset
+from .wids_mmtar import scan_tar_headers, scan_tar_headers_loop
+from .wids_tar import TarFileReader
+
+
+def make_shard(path, nsamples, extensions=("txt", "cls", "bin"), member_size=1000, seed=0):
+    """Write a tar shard of `nsamples` samples with members of about `member_size` bytes.
+
+    .cls members hold a class number and .txt members ascii text, so that they
+    decode; members with other extensions are random bytes.
+    """
+    rng = np.random.default_rng(seed)
+    with tarfile.open(path, "w", format=tarfile.GNU_FORMAT) as tar:
+        for i in range(nsamples):
+            for extension in extensions:
+                if extension == "cls":
+                    data = str(int(rng.integers(1000))).encode()
+                else:
+                    data = rng.integers(0, 256, int(rng.integers(1, 2 * member_size)), dtype=np.uint8)
+                    data = (data % 26 + ord("a") if extension == "txt" else data).astype(np.uint8).tobytes()
+                info = tarfile.TarInfo(f"sample{i:08d}.{extension}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def main_synth(args):
+    """Generate a synthetic shard for the other benchmarks."""
+    make_shard(args.output, args.samples, extensions=args.extensions.split(","), member_size=args.member_size)
+    print(args.output, os.path.getsize(args.output), "bytes")
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def main_cache(args):
+    """Download shards from a local http server through the cache and check that it stays within cache_size."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        shard_dir = os.path.join(tmpdir, "shards")
+        os.makedirs(shard_dir)
+        paths = [make_shard(os.path.join(shard_dir, f"shard-{i:04d}.tar"), args.samples, seed=i) for i in range(args.shards)]
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=shard_dir))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_address[1]}/"
+        shards = [(base + os.path.basename(path), args.samples) for path in paths]
+        shard_size = os.path.getsize(paths[0])
+        cache_size = args.cache_shards * shard_size
+        cache_dir = os.path.join(tmpdir, "cache")
+        dataset = wids.ShardListDataset(shards, cache_dir=cache_dir, cache_size=cache_size, lru_size=2, keep=True)
+        peak = 0
+        start = time.time()
+        for epoch in range(args.epochs):
+            for i in range(len(dataset)):
+                dataset[i]
+                if i % args.samples == args.samples - 1:
+                    peak = max(peak, sum(os.path.getsize(os.path.join(cache_dir, f)) for f in os.listdir(cache_dir) if f.endswith(".tar")))
+        elapsed = time.time() - start
+        dataset.close()
+        server.shutdown()
+        print(
+            f"shards={args.shards}",
+            f"shard_size={shard_size}",
+            f"cache_size={cache_size}",
+            f"peak={peak}",
+            f"within={peak <= cache_size + shard_size}",
+            f"samples/s={args.epochs * len(dataset) / max(elapsed, 1e-9):.0f}",
+            sep="\t",
+        )
 
 
 def main_wids(args):
@@ -15,7 +107,62 @@ def main_wids(args):
     dataset.close()
 
 
+def main_index(args):
+    """Compare the batched tar header scanner against the per-header loop."""
+    for fname in args.files:
+        with open(fname, "rb") as stream:
+            buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+            timings = {}
+            results = {}
+            for name, scan in [("loop", scan_tar_headers_loop), ("batched", scan_tar_headers)]:
+                best = float("inf")
+                for _ in range(args.repeat):
+                    start = time.time()
+                    results[name] = scan(buffer)
+                    best = min(best, time.time() - start)
+                timings[name] = best
+            buffer.close()
+        same = list(map(list, results["loop"])) == list(map(list, results["batched"]))
+        print(
+            fname,
+            f"members={len(results['batched'][0])}",
+            f"loop={timings['loop']:.4f}s",
+            f"batched={timings['batched']:.4f}s",
+            f"speedup={timings['loop'] / max(timings['batched'], 1e-9):.2f}x",
+            f"identical={same}",
+            sep="\t",
+        )
+
+
+def main_read(args):
+    """Measure how member reads of TarFileReader.get_files scale with threads."""
+    for fname in args.files:
+        reader = TarFileReader(fname, verbose=False)
+        indexes = np.random.default_rng(0).permutation(len(reader))[: args.members].tolist()
+        for num_threads in args.threads:
+            best = float("inf")
+            for _ in range(args.repeat):
+                if args.drop_cache:
+                    os.posix_fadvise(reader.tar_file.fileobj.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+                start = time.time()
+                files = reader.get_files(indexes, num_threads=num_threads)
+                best = min(best, time.time() - start)
+            nbytes = sum(len(data.getbuffer()) for _, data in files)
+            print(
+                fname,
+                f"threads={num_threads}",
+                f"members={len(indexes)}",
+                f"time={best:.4f}s",
+                f"members/s={len(indexes) / max(best, 1e-9):.0f}",
+                f"MB/s={nbytes / 1e6 / max(best, 1e-9):.1f}",
+                sep="\t",
+            )
+        reader.close()
+
+
 def main_wds(args):
+    from .compat import WebDataset
+
     desc = json.load(open(args.dataset))
     files = desc["files"]
     urls = [f["url"] for f in files]
@@ -30,6 +177,10 @@ if __name__ == "__main__":
     subparsers = parser.add_subparsers(dest="command")
     wids_parser = subparsers.add_parser("wids")
     wds_parser = subparsers.add_parser("wds")
+    index_parser = subparsers.add_parser("index")
+    read_parser = subparsers.add_parser("read")
+    synth_parser = subparsers.add_parser("synth")
+    cache_parser = subparsers.add_parser("cache")
 
     # wids subcommand
     wids_parser.add_argument("dataset", help="dataset name")
@@ -37,11 +188,42 @@ if __name__ == "__main__":
     # wds subcommand
     wds_parser.add_argument("dataset", help="dataset name")
 
+    # index subcommand
+    index_parser.add_argument("files", nargs="+", help="tar files to index")
+    index_parser.add_argument("--repeat", type=int, default=3, help="number of timing runs")
+
+    # read subcommand
+    read_parser.add_argument("files", nargs="+", help="tar files to read")
+    read_parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="thread counts")
+    read_parser.add_argument("--members", type=int, default=10000, help="number of random members read")
+    read_parser.add_argument("--repeat", type=int, default=3, help="number of timing runs")
+    read_parser.add_argument("--drop-cache", action="store_true", help="evict the shard from the page cache before each run")
+
+    # synth subcommand
+    synth_parser.add_argument("output", help="tar file to write")
+    synth_parser.add_argument("--samples", type=int, default=100000, help="number of samples")
+    synth_parser.add_argument("--extensions", default="txt,cls,bin", help="comma separated member extensions")
+    synth_parser.add_argument("--member-size", type=int, default=1000, help="average member size in bytes")
+
+    # cache subcommand
+    cache_parser.add_argument("--shards", type=int, default=10, help="number of shards to generate")
+    cache_parser.add_argument("--samples", type=int, default=1000, help="samples per shard")
+    cache_parser.add_argument("--cache-shards", type=int, default=3, help="cache_size in shards")
+    cache_parser.add_argument("--epochs", type=int, default=2, help="passes over the dataset")
+
     args = parser.parse_args()
 
     if args.command == "wids":
         main_wids(args)
     elif args.command == "wds":
         main_wds(args)
+    elif args.command == "index":
+        main_index(args)
+    elif args.command == "read":
+        main_read(args)
+    elif args.command == "synth":
+        main_synth(args)
+    elif args.command == "cache":
+        main_cache(args)
     else:
         raise ValueError(f"Unknown command: {args.command}")
@@ -1,54 +1,387 @@
 """
 This module provides utilities for managing files in a directory.
 
-It includes a function `keep_most_recent_files` that keeps the most recent 
-files in a directory, deleting the rest based on the maximum size of the directory 
-in bytes and the maximum number of files to keep.
+`CacheIndex` records the shards of a download directory in an sqlite
+database (`cache.db` in the directory): their size, when they were last
+opened and how many readers have them open. `ShardDiskCache` uses it to keep
+the directory below a byte budget, evicting least recently used shards that
+no process is currently reading, without listing the directory.
 
 The cleanup job can be run in the background using `create_cleanup_background_process`.
 """
 
+import errno
 import fcntl
-import glob
+import fnmatch
+import multiprocessing.util
 import os
+import sqlite3
+import threading
 import time
 
-import numpy as np
+from .wids_tarindex import remove_index_file
 
 
 def keep_most_recent_files(pattern, maxsize=int(1e12), maxfiles=1000, debug=False):
-    """Keep the most recent files in a directory, deleting the rest.
-
-    The maxsize is the maximum size of the directory in bytes. The maxfiles is
-    the maximum number of files to keep. The files are sorted by modification
-    time, and the most recent files are kept. If the directory is already
-    smaller than maxsize, then no files are deleted. If there are fewer than
-    maxfiles, then no files are deleted."""
-
-    # get the list of files in the directory
-    fnames = glob.glob(pattern)
-    # compute a list of (mtime, fname, size) triples
-    files = []
-    for fname in fnames:
+    """Keep the most recently used files in a directory, deleting the rest.
+
+    The maxsize is the maximum size of the files matching the glob `pattern`
+    in bytes. The maxfiles is the maximum number of them to keep. The files
+    are ordered by their last access as recorded in the `CacheIndex` of the
+    directory of `pattern`, and the most recent files are kept; files that
+    don't match the pattern are neither counted nor deleted."""
+    return ShardDiskCache(
+        os.path.dirname(pattern), cache_size=maxsize, max_files=maxfiles, pattern=os.path.basename(pattern)
+    ).enforce()
+
+
+# files in a cache directory that are bookkeeping rather than shards
+_CACHE_AUX_SUFFIXES = (".lock", ".temp", ".widx", ".db", ".db-journal", ".db-wal", ".db-shm")
+
+
+def unlink_if_unused(fname):
+    """Delete a file unless some process holds a shared flock on it.
+
+    Readers of cached shards hold a shared lock for as long as they have the
+    shard open (see `keep_while_reading`), so this never deletes a shard that
+    is still mmapped. Returns True if the file was deleted.
+    """
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    try:
+        os.unlink(fname)
+        remove_index_file(fname)
+        return True
+    except FileNotFoundError:
+        return False
+    finally:
+        os.close(fd)
+
+
+# indexes with a connection in this process, closed (and so flushed) when it exits
+_exit_indexes = set()
+_exit_pid = None
+
+
+def _close_exit_indexes():
+    for index in list(_exit_indexes):
+        index.close()
+
+
+def _close_at_exit(index):
+    global _exit_pid
+    if _exit_pid != os.getpid():
+        # multiprocessing runs its finalizers both at interpreter exit and when
+        # a child process (e.g. a DataLoader worker) exits, which skips atexit
+        _exit_pid = os.getpid()
+        _exit_indexes.clear()
+        multiprocessing.util.Finalize(None, _close_exit_indexes, exitpriority=0)
+    _exit_indexes.add(index)
+
+
+class CacheIndex:
+    """An sqlite index of the shards in a cache directory.
+
+    Every process uses its own connection to the database, which is in WAL
+    mode, so readers never wait for writers. Updates are buffered and
+    committed in batches, every `batch_size` updates or `flush_interval`
+    seconds, before every query, and by `close`, which also runs when the
+    process exits. The database only orders shards for
+    eviction: whether a shard may actually be deleted is still decided by
+    the flock protocol of `unlink_if_unused`, so stale rows (e.g. pins of
+    a process that crashed) are harmless.
+
+    The directory is scanned only when the database is created, to pick up
+    shards downloaded before it existed.
+    """
+
+    def __init__(self, cache_dir, batch_size=256, flush_interval=1.0):
+        self.cache_dir = cache_dir
+        self.db_file = os.path.join(cache_dir, "cache.db")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pid = None
+        self._connection = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(_pid=None, _connection=None, _lock=None, pending=None, pending_urls=None)
+        return state
+
+    def connection(self):
+        # a forked child must not use the connection of its parent
+        if self._pid != os.getpid():
+            os.makedirs(self.cache_dir, exist_ok=True)
+            connection = sqlite3.connect(self.db_file, timeout=60, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                self._create_tables(connection)
+            self._connection = connection
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self.pending = []
+            self.pending_urls = []
+            self.last_flush = time.time()
+            _close_at_exit(self)
+            if connection.execute("SELECT count(*) FROM shards").fetchone()[0] == 0:
+                self.rescan()
+        return self._connection
+
+    def _create_tables(self, connection):
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS shards (path TEXT PRIMARY KEY, size INTEGER, last_access REAL, pins INTEGER)"
+        )
+        connection.execute("DROP INDEX IF EXISTS shards_lru")
+        connection.execute("CREATE INDEX IF NOT EXISTS shards_lru_path ON shards (pins > 0, last_access, path)")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)")
+        # the total size and count of the shards, kept up to date by triggers
+        connection.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, size INTEGER, count INTEGER)")
+        connection.execute("INSERT OR IGNORE INTO totals SELECT 0, coalesce(sum(size), 0), count(*) FROM shards")
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS shards_insert AFTER INSERT ON shards BEGIN "
+            "UPDATE totals SET size = size + coalesce(new.size, 0), count = count + 1; END"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS shards_delete AFTER DELETE ON shards BEGIN "
+            "UPDATE totals SET size = size - coalesce(old.size, 0), count = count - 1; END"
+        )
+        connection.execute(
+            "CREATE TRIGGER IF NOT EXISTS shards_resize AFTER UPDATE OF size ON shards BEGIN "
+            "UPDATE totals SET size = size + coalesce(new.size, 0) - coalesce(old.size, 0); END"
+        )
+
+    def close(self):
+        """Commit the buffered updates and close the connection of this process."""
+        if self._pid != os.getpid():
+            return
+        self.flush()
+        self._connection.close()
+        self._pid = self._connection = None
+        _exit_indexes.discard(self)
+
+    def record(self, path, size=None, pins=0, now=None):
+        """Record an access to a shard, changing its pin count by `pins`."""
+        connection = self.connection()
+        with self._lock:
+            self.pending.append((path, size, time.time() if now is None else now, pins))
+        self._maybe_flush(connection)
+
+    def record_url(self, url, path):
+        """Record the url a shard was downloaded from."""
+        connection = self.connection()
+        with self._lock:
+            self.pending_urls.append((url, path, None))
+        self._maybe_flush(connection)
+
+    def _maybe_flush(self, connection):
+        if len(self.pending) + len(self.pending_urls) >= self.batch_size or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Commit the buffered updates in one transaction."""
+        connection = self.connection()
+        with self._lock:
+            pending, self.pending = self.pending, []
+            pending_urls, self.pending_urls = self.pending_urls, []
+            self.last_flush = time.time()
+            if not pending and not pending_urls:
+                return
+            with connection:
+                connection.execute("BEGIN")
+                connection.executemany(
+                    "INSERT INTO shards VALUES (?, ?, ?, max(?, 0)) ON CONFLICT (path) DO UPDATE SET "
+                    "size = coalesce(excluded.size, size), last_access = max(last_access, excluded.last_access), "
+                    "pins = max(pins + ?, 0)",
+                    [(path, size, now, pins, pins) for path, size, now, pins in pending],
+                )
+                connection.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?)", pending_urls)
+
+    def rescan(self):
+        """Synchronize the index with the files in the cache directory."""
+        connection = self.connection()
+        found = []
         try:
-            s = os.stat(fname)
+            scan = os.scandir(self.cache_dir)
         except FileNotFoundError:
-            continue
-        files.append((s.st_mtime, fname, s.st_size))
-    # sort the list by mtime, most recent first
-    files.sort(reverse=True)
-    # compute an accumulated total of the file sizes in order using np.cumsum
-    sizes = np.cumsum([size for mtime, fname, size in files])
-    # compute a cutoff index based on maxsize
-    cutoff = np.searchsorted(sizes, maxsize)
-    # compute a cutoff index based on maxfiles
-    cutoff = min(cutoff, maxfiles)
-    # delete the files above the cutoff in reverse order
-    for mtime, fname, size in files[cutoff:][::-1]:
+            scan = None
+        if scan is not None:
+            with scan:
+                for entry in scan:
+                    if entry.name.startswith(".") or entry.name.endswith(_CACHE_AUX_SUFFIXES):
+                        continue
+                    try:
+                        if not entry.is_file(follow_symlinks=False):
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    found.append((entry.path, st.st_size, st.st_atime_ns / 1e9, 0, 0))
+        self.flush()
+        with self._lock, connection:
+            connection.execute("BEGIN")
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS found (path TEXT PRIMARY KEY)")
+            connection.execute("DELETE FROM found")
+            connection.executemany("INSERT OR IGNORE INTO found VALUES (?)", [(row[0],) for row in found])
+            connection.execute("DELETE FROM shards WHERE path NOT IN (SELECT path FROM found)")
+            connection.executemany(
+                "INSERT INTO shards VALUES (?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+                "size = excluded.size, last_access = max(last_access, excluded.last_access), pins = pins + ?",
+                found,
+            )
+
+    def totals(self):
+        """Return the total size and the number of indexed shards."""
+        self.flush()
+        size, count = self.connection().execute("SELECT size, count FROM totals").fetchone()
+        return size, count
+
+    def lru(self, batch_size=64):
+        """Yield (last access, path, size) triples, least recently used unpinned shards first.
+
+        The shards are read from the database `batch_size` at a time, so
+        that finding a few shards to evict does not load the whole index.
+        """
+        self.flush()
+        for pinned in (False, True):
+            key = (float("-inf"), "")
+            while True:
+                # every batch seeks to the end of the previous one in the shards_lru_path index
+                rows = (
+                    self.connection()
+                    .execute(
+                        "SELECT last_access, path, size FROM shards WHERE pins > 0 = ? AND (last_access, path) > (?, ?) "
+                        "ORDER BY last_access, path LIMIT ?",
+                        (pinned, *key, batch_size),
+                    )
+                    .fetchall()
+                )
+                yield from rows
+                if len(rows) < batch_size:
+                    break
+                key = rows[-1][:2]
+
+    def entries(self):
+        """Return (last access, path, size) triples, least recently used unpinned shards first."""
+        return list(self.lru())
+
+    def forget(self, paths):
+        connection = self.connection()
+        with self._lock, connection:
+            connection.execute("BEGIN")
+            connection.executemany("DELETE FROM shards WHERE path = ?", [(path,) for path in paths])
+
+
+_cache_indexes = {}
+_cache_indexes_lock = threading.Lock()
+
+
+def cache_index(cache_dir):
+    """Return the `CacheIndex` of a cache directory, shared by all its users in this process."""
+    key = (os.getpid(), os.path.abspath(cache_dir))
+    with _cache_indexes_lock:
+        if key not in _cache_indexes:
+            _cache_indexes[key] = CacheIndex(cache_dir)
+        return _cache_indexes[key]
+
+
+class ShardDiskCache:
+    """Keep the shards downloaded into a directory below a byte budget.
+
+    Shards are recorded in a `CacheIndex` when they are downloaded (`touch`)
+    and opened or closed (`pin`/`unpin`). When the directory holds more than
+    `cache_size` bytes (or more than `max_files` shards), the least recently
+    used shards are deleted, unpinned ones first, skipping shards that are
+    being read or downloaded. This is safe with several DataLoader workers
+    and ranks sharing the directory, since deletion only relies on the flock
+    protocol of `keep_while_reading` and on download lock files.
+
+    If a glob `pattern` is given, only the shards whose file names match it
+    are counted and evicted.
+    """
+
+    def __init__(self, cache_dir, cache_size=int(1e12), max_files=None, pattern=None):
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.max_files = max_files
+        self.pattern = pattern
+        self.index = cache_index(cache_dir)
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+    def _size(self, fname):
         try:
-            os.unlink(fname)
-        except FileNotFoundError:
-            pass
+            return os.stat(fname).st_size
+        except OSError:
+            return None
+
+    def touch(self, fname):
+        """Mark a shard as used now."""
+        self.index.record(fname, self._size(fname))
+
+    def pin(self, fname):
+        """Mark a shard as used now and opened by one more reader."""
+        self.index.record(fname, self._size(fname), pins=1)
+
+    def unpin(self, fname):
+        """Mark a shard as closed by one of its readers."""
+        self.index.record(fname, pins=-1)
+
+    def close(self):
+        """Commit the buffered updates of the index."""
+        self.index.close()
+
+    def _lru(self):
+        for entry in self.index.lru():
+            if self.pattern is None or fnmatch.fnmatch(os.path.basename(entry[1]), self.pattern):
+                yield entry
+
+    def entries(self):
+        """Return a list of (atime, fname, size) triples for the cached shards."""
+        return list(self._lru())
+
+    def _totals(self):
+        if self.pattern is None:
+            # kept up to date by the database, so this does not read the shards
+            return self.index.totals()
+        entries = self.entries()
+        return sum(size or 0 for _, _, size in entries), len(entries)
+
+    def total_size(self):
+        return self._totals()[0]
+
+    def enforce(self):
+        """Evict least recently used shards until the cache fits the budget."""
+        total, count = self._totals()
+        max_files = count if self.max_files is None else self.max_files
+        if total <= self.cache_size and count <= max_files:
+            return total
+        removed = []
+        for _, fname, size in self._lru():
+            if total <= self.cache_size and count <= max_files:
+                break
+            if os.path.exists(fname + ".lock"):
+                # still being downloaded
+                continue
+            if unlink_if_unused(fname):
+                self.evicted_files += 1
+                self.evicted_bytes += size or 0
+            elif os.path.exists(fname):
+                continue
+            # deleted by us, or already by a reader (see `keep_while_reading`)
+            removed.append(fname)
+            total -= size or 0
+            count -= 1
+        self.index.forget(removed)
+        return total
 
 
 class ExclusiveLock:
@@ -76,7 +409,12 @@ class ExclusiveLock:
 def create_cleanup_background_process(
     pattern, maxsize=int(1e12), maxfiles=1000, every=60
 ):
-    """Create a background process that keeps a directory below a certain size."""
+    """Create a background process that keeps a directory below a certain size.
+
+    The directory is that of `pattern`; the shards in it that match `pattern`
+    are found through its `CacheIndex` rather than by listing it (see
+    `keep_most_recent_files`).
+    """
 
     def cleanup_worker(every):
         # use a lock file to ensure that only one cleanup worker is running
@@ -84,8 +422,11 @@ def create_cleanup_background_process(
         lock = ExclusiveLock(lockfile)
         if not lock.try_lock():
             return
+        cache = ShardDiskCache(
+            os.path.dirname(pattern), cache_size=maxsize, max_files=maxfiles, pattern=os.path.basename(pattern)
+        )
         while True:
-            keep_most_recent_files(pattern, maxsize=maxsize, maxfiles=maxfiles)
+            cache.enforce()
             time.sleep(every)
 
     import multiprocessing
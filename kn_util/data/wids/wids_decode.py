@@ -0,0 +1,280 @@
+"""
+Decoding of sample fields by file extension.
+
+Decoders are registered per extension in `decoders`, and `Decoder` applies
+them to samples. Modules needed by decoders (PIL, msgpack, torch) are
+imported the first time a field that needs them is decoded, rather than on
+every field. A `Decoder` can be restricted to some of the fields of a sample,
+leaving the others as raw streams, and can decode the fields of a sample or
+of a batch of samples with a thread pool, which pays off for image decoding
+since PIL, zlib and numpy release the GIL.
+"""
+
+import gzip
+import importlib
+import io
+import json
+import pickle
+from functools import partial
+
+import numpy as np
+
+from .wids_mmtar import MemoryViewIO
+from .wids_utils import get_executor
+
+_modules = {}
+
+
+def lazy_import(name):
+    """Import a module the first time it is needed."""
+    module = _modules.get(name)
+    if module is None:
+        module = _modules[name] = importlib.import_module(name)
+    return module
+
+
+def read_buffer(stream):
+    """Return the rest of a sample stream as a bytes-like object.
+
+    Streams that expose their buffer (`io.BytesIO`, `MemoryViewIO`) are not
+    copied; the result is a read-only view in that case.
+    """
+    if hasattr(stream, "getbuffer"):
+        return stream.getbuffer()[stream.tell() :]
+    return stream.read()
+
+
+def load_npy(stream):
+    """Load a .npy stream, referencing the data in place for `MemoryViewIO` streams.
+
+    Arrays loaded without a copy are read-only views of the shard.
+    """
+    if isinstance(stream, MemoryViewIO):
+        start = stream.tell()
+        version = np.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(stream)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(stream)
+        if not dtype.hasobject:
+            count = int(np.prod(shape, dtype=np.int64))
+            array = np.frombuffer(stream.getbuffer(), dtype=dtype, count=count, offset=stream.tell())
+            return array.reshape(shape, order="F" if fortran_order else "C")
+        stream.seek(start)
+    return np.load(stream)
+
+
+# extension -> function(stream, format) returning the decoded value
+decoders = {}
+
+
+def register_decoder(*extensions):
+    """Register a decoder function for some extensions (without the dot)."""
+
+    def register(fn):
+        for extension in extensions:
+            decoders[extension] = fn
+        return fn
+
+    return register
+
+
+@register_decoder("txt", "text")
+def decode_text(stream, format):
+    return str(read_buffer(stream), "utf-8")
+
+
+@register_decoder("cls", "cls2")
+def decode_class(stream, format):
+    return int(str(read_buffer(stream), "utf-8"))
+
+
+IMAGE_EXTENSIONS = ("jpg", "png", "ppm", "pgm", "pbm", "pnm")
+
+
+@register_decoder(*IMAGE_EXTENSIONS)
+def decode_image(stream, format):
+    image = lazy_import("PIL.Image").open(stream)
+    if format == "PIL":
+        return image
+    elif format == "numpy":
+        return np.asarray(image)
+    else:
+        raise ValueError(f"Unknown format: {format}")
+
+
+def reduced_size(width, height, size):
+    """Return the (width, height) an image is resized to: an int `size` is the
+    length of the shorter side, a pair is the exact (width, height)."""
+    if isinstance(size, int):
+        scale = size / min(width, height)
+        return max(1, round(width * scale)), max(1, round(height * scale))
+    return tuple(size)
+
+
+def _reduction(width, height, target):
+    """Return the largest of 1, 2, 4, 8 an image can be shrunk by while still covering target."""
+    factor = 1
+    while factor < 8 and width // (factor * 2) >= target[0] and height // (factor * 2) >= target[1]:
+        factor *= 2
+    return factor
+
+
+def _have_cv2():
+    try:
+        lazy_import("cv2")
+        return True
+    except ImportError:
+        return False
+
+
+def decode_image_reduced(stream, format="numpy", size=224, out=None, backend="auto"):
+    """Decode an image directly at a reduced resolution and resize it to `size`.
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale by the DCT scaling of the
+    decoder, to the smallest scale that still covers the target size, which
+    is much faster than decoding at full resolution and then resizing.
+    Other formats are decoded fully and resized.
+
+    Args:
+        stream: the encoded image
+        format: "numpy" for an RGB uint8 array, "PIL" for an image
+        size: see `reduced_size`; ignored if `out` is given
+        out: optional (height, width, 3) uint8 array the result is written to
+        backend: "cv2" (IMREAD_REDUCED_* flags), "PIL" (`Image.draft`) or
+            "auto" for cv2 if it is installed; with cv2, results are written
+            into `out` without an intermediate copy
+    """
+    PIL_Image = lazy_import("PIL.Image")
+    if out is not None:
+        assert out.dtype == np.uint8 and out.ndim == 3 and out.shape[2] == 3, "out must be a (height, width, 3) uint8 array"
+        size = (out.shape[1], out.shape[0])
+    if backend == "auto":
+        backend = "cv2" if _have_cv2() else "PIL"
+    start = stream.tell()
+    image = PIL_Image.open(stream)
+    target = reduced_size(*image.size, size)
+    if backend == "cv2":
+        cv2 = lazy_import("cv2")
+        factor = _reduction(*image.size, target)
+        flags = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+        stream.seek(start)
+        array = cv2.imdecode(np.frombuffer(read_buffer(stream), dtype=np.uint8), flags[factor])
+        if array is None:
+            raise ValueError("cv2 could not decode the image")
+        if (array.shape[1], array.shape[0]) != target:
+            array = cv2.resize(array, target, interpolation=cv2.INTER_AREA)
+        array = cv2.cvtColor(array, cv2.COLOR_BGR2RGB, dst=out)
+        return PIL_Image.fromarray(array) if format == "PIL" else array
+    elif backend == "PIL":
+        image.draft("RGB", target)
+        image = image.convert("RGB")
+        if image.size != target:
+            image = image.resize(target, PIL_Image.BILINEAR)
+        if format == "PIL":
+            return image
+        if out is None:
+            return np.asarray(image)
+        out[...] = np.asarray(image)
+        return out
+    else:
+        raise ValueError(f"Unknown backend: {backend}")
+
+
+@register_decoder("json")
+def decode_json(stream, format):
+    return json.loads(str(read_buffer(stream), "utf-8"))
+
+
+@register_decoder("npy")
+def decode_npy(stream, format):
+    return load_npy(stream)
+
+
+@register_decoder("mp")
+def decode_msgpack(stream, format):
+    return lazy_import("msgpack").unpackb(read_buffer(stream), raw=False)
+
+
+@register_decoder("pt", "pth")
+def decode_torch(stream, format):
+    return lazy_import("torch").load(stream)
+
+
+@register_decoder("pickle", "pkl")
+def decode_pickle(stream, format):
+    return pickle.loads(read_buffer(stream))
+
+
+class Decoder:
+    """Decode the fields of samples according to their extensions.
+
+    Samples are decoded in place. Fields whose key starts with "__" and
+    fields without a registered decoder are left alone; ".gz" fields are
+    decompressed and then decoded by their inner extension.
+
+    Args:
+        format: "PIL" or "numpy", how images are returned
+        keys: the extensions of the fields to decode (e.g. ["jpg", "cls"]),
+            or None for all fields; the other fields stay raw streams
+        num_threads: decode the fields of a sample (or a batch, see
+            `apply_batch`) with this many threads; 0 decodes serially
+        decoders: decoders overriding or extending the registered ones
+        image_size: decode images at reduced resolution and resize them to
+            this size (see `decode_image_reduced`)
+        image_backend: backend of `decode_image_reduced`
+    """
+
+    def __init__(self, format="PIL", keys=None, num_threads=0, decoders=None, image_size=None, image_backend="auto"):
+        self.format = format
+        self.keys = None if keys is None else {key.lstrip(".") for key in keys}
+        self.num_threads = num_threads
+        self.decoders = {}
+        if image_size is not None:
+            reduced = partial(decode_image_reduced, size=image_size, backend=image_backend)
+            self.decoders.update({extension: reduced for extension in IMAGE_EXTENSIONS})
+        self.decoders.update(decoders or {})
+
+    def find_decoder(self, key):
+        """Return the decoder of a field and whether it is gzipped, or (None, False)."""
+        if key.startswith("__"):
+            return None, False
+        name = key.lstrip(".")
+        if self.keys is not None and name not in self.keys:
+            return None, False
+        extensions = name.split(".")
+        gzipped = extensions[-1] == "gz"
+        if gzipped:
+            extensions = extensions[:-1]
+        extension = extensions[-1] if extensions else ""
+        decoder = self.decoders.get(extension) or decoders.get(extension)
+        return decoder, gzipped
+
+    def decode_field(self, key, stream):
+        decoder, gzipped = self.find_decoder(key)
+        if gzipped:
+            stream = io.BytesIO(gzip.decompress(read_buffer(stream)))
+        if decoder is None:
+            return stream
+        return decoder(stream, self.format)
+
+    def _fields(self, sample):
+        return [key for key in sample if self.find_decoder(key) != (None, False)]
+
+    def _decode_fields(self, fields):
+        """Decode a list of (sample, key) pairs in place."""
+        if self.num_threads > 1 and len(fields) > 1:
+            values = get_executor("wids-decode", self.num_threads).map(lambda field: self.decode_field(field[1], field[0][field[1]]), fields)
+        else:
+            values = (self.decode_field(key, sample[key]) for sample, key in fields)
+        for (sample, key), value in zip(fields, list(values)):
+            sample[key] = value
+
+    def __call__(self, sample):
+        self._decode_fields([(sample, key) for key in self._fields(sample)])
+        return sample
+
+    def apply_batch(self, samples):
+        """Decode a list of samples, spreading all their fields over the thread pool."""
+        self._decode_fields([(sample, key) for sample in samples for key in self._fields(sample)])
+        return samples
@@ -1,16 +1,22 @@
 import fcntl
+import itertools
 import os
 import shutil
 import sys
+import threading
 import time
+import warnings
+import weakref
 from collections import deque
-from datetime import datetime
 from urllib.parse import urlparse
 
 recent_downloads = deque(maxlen=1000)
 
-open_objects = {}
+# files returned by download_and_open that are still referenced somewhere;
+# set to None to disable tracking
+open_objects = weakref.WeakValueDictionary()
 max_open_objects = 100
+_open_object_ids = itertools.count()
 
 
 class ULockFile:
@@ -66,19 +72,191 @@ def vcmd(flag, verbose_flag=""):
     return verbose_flag if verbose_cmd else flag
 
 
+# options for http_download; can be set from the environment or changed at runtime
+http_options = dict(
+    # number of retries after the first attempt, with exponential backoff
+    retries=int(os.environ.get("WIDS_HTTP_RETRIES", "5")),
+    backoff=float(os.environ.get("WIDS_HTTP_BACKOFF", "1.0")),
+    timeout=float(os.environ.get("WIDS_HTTP_TIMEOUT", "60")),
+    # download files of at least range_threshold bytes in this many parallel ranges
+    parallel_ranges=int(os.environ.get("WIDS_HTTP_PARALLEL_RANGES", "1")),
+    range_threshold=int(os.environ.get("WIDS_HTTP_RANGE_THRESHOLD", str(64 * 1024 * 1024))),
+    chunk_size=1024 * 1024,
+    max_connections=int(os.environ.get("WIDS_HTTP_MAX_CONNECTIONS", "16")),
+)
+
+# per process download statistics of http_download
+http_stats = dict(requests=0, retries=0, bytes=0, seconds=0.0)
+
+_http_client = None
+_http_client_pid = None
+_http_client_lock = threading.Lock()
+
+
+def http_client():
+    """Return the keep-alive HTTP client shared by all downloads of this process."""
+    global _http_client, _http_client_pid
+    with _http_client_lock:
+        # connections must not be shared with a forked parent
+        if _http_client is None or _http_client_pid != os.getpid():
+            import httpx
+
+            limits = httpx.Limits(
+                max_connections=http_options["max_connections"],
+                max_keepalive_connections=http_options["max_connections"],
+            )
+            _http_client = httpx.Client(follow_redirects=True, timeout=http_options["timeout"], limits=limits)
+            _http_client_pid = os.getpid()
+        return _http_client
+
+
+class RangesNotSupported(Exception):
+    """The server does not answer Range requests for a url."""
+
+
+class ShortReadError(IOError):
+    """A response ended before all the requested bytes were received."""
+
+
+def _http_get_to_file(client, url, fname):
+    with client.stream("GET", url) as response:
+        response.raise_for_status()
+        with open(fname, "wb") as stream:
+            for chunk in response.iter_bytes(http_options["chunk_size"]):
+                stream.write(chunk)
+                http_stats["bytes"] += len(chunk)
+
+
+def _http_get_range(client, url, fd, lo, hi):
+    with client.stream("GET", url, headers={"Range": f"bytes={lo}-{hi - 1}"}) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangesNotSupported(url)
+        offset = lo
+        for chunk in response.iter_bytes(http_options["chunk_size"]):
+            os.pwrite(fd, chunk, offset)
+            offset += len(chunk)
+            http_stats["bytes"] += len(chunk)
+        if offset != hi:
+            raise ShortReadError(f"short range read for {url}: got {offset - lo} of {hi - lo} bytes")
+
+
+def _http_get_ranges(client, url, fname, size, nparts):
+    from concurrent.futures import ThreadPoolExecutor
+
+    bounds = [size * i // nparts for i in range(nparts + 1)]
+    with open(fname, "wb") as stream:
+        stream.truncate(size)
+        with ThreadPoolExecutor(nparts) as pool:
+            futures = [pool.submit(_http_get_range, client, url, stream.fileno(), lo, hi) for lo, hi in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+
+
+def _http_fetch(url, fname):
+    client = http_client()
+    nparts = http_options["parallel_ranges"]
+    if nparts > 1:
+        head = client.head(url)
+        size = int(head.headers.get("content-length", -1))
+        if head.status_code == 200 and head.headers.get("accept-ranges") == "bytes" and size >= http_options["range_threshold"]:
+            try:
+                return _http_get_ranges(client, url, fname, size, nparts)
+            except RangesNotSupported:
+                pass
+    _http_get_to_file(client, url, fname)
+
+
+def _is_retryable(exn):
+    """Network errors, timeouts and 408/429/5xx responses are retried, local errors
+    (e.g. a full disk) and other responses are not."""
+    import httpx
+
+    if isinstance(exn, httpx.HTTPStatusError):
+        return exn.response.status_code in (408, 429) or exn.response.status_code >= 500
+    return isinstance(exn, (httpx.TransportError, ShortReadError))
+
+
+def http_retry(fn, url):
+    """Call `fn()`, retrying transient http failures of `url` with exponential backoff."""
+    for attempt in range(http_options["retries"] + 1):
+        http_stats["requests"] += 1
+        try:
+            return fn()
+        except Exception as exn:
+            if attempt == http_options["retries"] or not _is_retryable(exn):
+                raise
+            http_stats["retries"] += 1
+            delay = http_options["backoff"] * 2**attempt
+            if verbose_cmd:
+                print(f"retrying {url} in {delay:.1f}s after {exn!r}", file=sys.stderr)
+            time.sleep(delay)
+
+
+def http_download(remote, local):
+    """Download an http(s) url in-process.
+
+    The download uses the keep-alive connection pool of `http_client`, streams
+    into `local`, retries transient failures with exponential backoff, and
+    optionally fetches large files in parallel byte ranges (see `http_options`).
+    Like the other handlers, it is called by `download_file_no_log` with a
+    temporary name that is renamed into place when the download is complete.
+    """
+    start = time.time()
+    try:
+        http_retry(lambda: _http_fetch(remote, local), remote)
+    finally:
+        http_stats["seconds"] += time.time() - start
+
+
+def http_size(url):
+    """Return the size of an http(s) resource, raising RangesNotSupported if
+    the server does not serve byte ranges of it."""
+
+    def head():
+        response = http_client().head(url)
+        response.raise_for_status()
+        return response
+
+    response = http_retry(head, url)
+    if response.headers.get("accept-ranges") != "bytes" or "content-length" not in response.headers:
+        raise RangesNotSupported(url)
+    return int(response.headers["content-length"])
+
+
+def http_read_range(url, lo, hi):
+    """Return bytes [lo, hi) of an http(s) resource, using a Range request."""
+
+    def get():
+        response = http_client().get(url, headers={"Range": f"bytes={lo}-{hi - 1}"})
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangesNotSupported(url)
+        if len(response.content) != hi - lo:
+            raise ShortReadError(f"short range read for {url}: got {len(response.content)} of {hi - lo} bytes")
+        return response.content
+
+    start = time.time()
+    try:
+        data = http_retry(get, url)
+    finally:
+        http_stats["seconds"] += time.time() - start
+    http_stats["bytes"] += len(data)
+    return data
+
+
 default_cmds = {
     "posixpath": copy_file,
     "file": copy_file,
     "pipe": pipe_download,
-    "http": "curl " + vcmd("-s") + " -L {url} -o {local}",
-    "https": "curl " + vcmd("-s") + " -L {url} -o {local}",
+    "http": http_download,
+    "https": http_download,
     "ftp": "curl " + vcmd("-s") + " -L {url} -o {local}",
     "ftps": "curl " + vcmd("-s") + " -L {url} -o {local}",
     "gs": "gsutil " + vcmd("-q") + " cp {url} {local}",
     "s3": "aws s3 cp {url} {local}",
 }
 
-#TODO(ligeng): change HTTPS download to python requests library
 
 def download_file_no_log(remote, local, handlers=default_cmds):
     """Download a file from a remote url to a local path.
@@ -96,13 +274,20 @@ def download_file_no_log(remote, local, handlers=default_cmds):
     handler = handlers.get(schema)
     if handler is None:
         raise ValueError("Unknown schema: %s" % schema)
-    # call the handler
-    if callable(handler):
-        handler(remote, local)
-    else:
-        assert isinstance(handler, str)
-        cmd = handler.format(url=remote, local=local)
-        assert os.system(cmd) == 0, "Command failed: %s" % cmd
+    # download under a temporary name, so that `local` only ever exists complete
+    temp = f"{local}.{os.getpid()}.{threading.get_ident()}.temp"
+    try:
+        # call the handler
+        if callable(handler):
+            handler(remote, temp)
+        else:
+            assert isinstance(handler, str)
+            cmd = handler.format(url=remote, local=temp)
+            assert os.system(cmd) == 0, "Command failed: %s" % cmd
+        os.replace(temp, local)
+    finally:
+        if os.path.exists(temp):
+            os.unlink(temp)
     return local
 
 
@@ -125,31 +310,44 @@ def download_file(remote, local, handlers=default_cmds, verbose=False):
             )
 
 
+def _open_present(remote, local, mode, verbose=False):
+    """Open a local file in place or an already downloaded copy, or return None."""
+    if os.path.exists(remote):
+        return open(remote, mode)
+    try:
+        result = open(local, mode)
+    except FileNotFoundError:
+        return None
+    if verbose:
+        print("using cached", local, file=sys.stderr)
+    return result
+
+
+def register_open_object(stream, remote, local, mode):
+    """Track a file returned by download_and_open, warning if too many are alive."""
+    if open_objects is None:
+        return
+    open_objects[(remote, local, mode, next(_open_object_ids))] = stream
+    if len(open_objects) > max_open_objects:
+        warnings.warn(f"more than {max_open_objects} files opened by download_and_open are still referenced")
+
+
 def download_and_open(remote, local, mode="rb", handlers=default_cmds, verbose=False):
-    with ULockFile(local + ".lock"):
-        if os.path.exists(remote):
-            # print("enter1", remote, local, mode)
-            result = open(remote, mode)
-        else:
-            # print("enter2", remote, local, mode)
-            if not os.path.exists(local):
+    """Open `remote`, downloading it to `local` first unless it is local or already there.
+
+    Downloads are renamed into place when complete, so a file found under
+    `local` can be opened without locking. Only when it is missing is the
+    download lock taken, and the check repeated under it, since another
+    process may have downloaded the file in the meantime.
+    """
+    result = _open_present(remote, local, mode, verbose=verbose)
+    if result is None:
+        with ULockFile(local + ".lock"):
+            result = _open_present(remote, local, mode, verbose=verbose)
+            if result is None:
                 if verbose:
                     print("downloading", remote, "to", local, file=sys.stderr)
                 download_file(remote, local, handlers=handlers)
-            else:
-                if verbose:
-                    print("using cached", local, file=sys.stderr)
-            result = open(local, mode)
-        
-        # input()
-        
-        if open_objects is not None:
-            for k, v in list(open_objects.items()):
-                if v.closed:
-                    del open_objects[k]
-            if len(open_objects) > max_open_objects:
-                raise RuntimeError("Too many open objects")
-            current_time = datetime.now().strftime("%Y%m%d%H%M%S")
-            key = tuple(str(x) for x in [remote, local, mode, current_time])
-            open_objects[key] = result
-        return result
+                result = open(local, mode)
+    register_open_object(result, remote, local, mode)
+    return result
@@ -1,14 +1,21 @@
 import argparse
+import hashlib
 import json
+import mmap
 import os
 import re
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from urllib.parse import urlparse, urlunparse
 
 import braceexpand
 
 from . import wids, wids_dl
+from .wids_mmtar import scan_tar_headers
 from .wids_specs import load_remote_dsdesc_raw
+from .wids_tarindex import find_index_file, group_members, load_or_build_tar_index, save_tar_index
 
 
 def format_with_suffix(num):
@@ -98,8 +105,74 @@ def shorten_name(s):
     return "-".join(result)
 
 
+def index_local_shard(fname, index_file=None, chunksize=1 << 24):
+    """Compute the md5sum, sample count and size of a local shard in one read pass.
+
+    The shard is mmapped: hashing it reads it once from disk, and the tar
+    header scan that follows only touches pages already in the page cache.
+    If `index_file` is given, the sidecar index is loaded from or written
+    there. Returns a dictionary with md5sum, nsamples and filesize, and the
+    index itself (as returned by `load_tar_index`).
+    """
+    md5 = hashlib.md5()
+    with open(fname, "rb") as stream:
+        filesize = os.fstat(stream.fileno()).st_size
+        if filesize == 0:
+            names = []
+            return dict(md5sum=md5.hexdigest(), nsamples=0, filesize=0), dict(
+                names=names, offsets=[], sizes=[], groups=group_members(names)
+            )
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, filesize, chunksize):
+                md5.update(mapped[offset : offset + chunksize])
+            index = load_or_build_tar_index(index_file, stream.fileno(), lambda: scan_tar_headers(mapped))
+    nsamples = len(index["groups"]["sample_offsets"]) - 1
+    return dict(md5sum=md5.hexdigest(), nsamples=nsamples, filesize=filesize), index
+
+
+def index_shard(url, tmpdir=None, index_dir=None):
+    """Index a single shard for `wids_index create`; runs in a worker process.
+
+    Local shards get their sidecar index at the default location (see
+    `find_index_file`). Remote shards are downloaded to `tmpdir` and, if
+    `index_dir` is given, their index is written to `index_dir/<shard>.widx`
+    so that it can be published next to the shard for range reads.
+    """
+    if os.path.exists(url):
+        info, _ = index_local_shard(url, index_file=find_index_file(url))
+        return dict(url=url, **info)
+    tmpdir = tmpdir or tempfile.gettempdir()
+    local = os.path.join(tmpdir, f"wids-index-{os.getpid()}-{urlfile(url)}")
+    try:
+        wids_dl.download_file(url, local)
+        info, index = index_local_shard(local)
+        if index_dir is not None:
+            # remote indexes can only be validated by the shard size
+            index_file = os.path.join(index_dir, urlfile(url) + ".widx")
+            stat = dict(shard_size=info["filesize"])
+            save_tar_index(index_file, None, index["names"], index["offsets"], index["sizes"], index["groups"], stat=stat)
+    finally:
+        if os.path.exists(local):
+            os.remove(local)
+    return dict(url=url, **info)
+
+
+def write_json_atomic(fname, data):
+    temp = f"{fname}.{os.getpid()}.temp"
+    with open(temp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(temp, fname)
+
+
 def main_create(args):
-    """Create a full shard index for a list of files."""
+    """Create a full shard index for a list of files.
+
+    Shards are indexed in parallel by `args.jobs` processes. Progress is
+    checkpointed to the output file, marked with `"partial": true`, so that
+    rerunning the same command after an interruption only indexes the
+    shards that are still missing.
+    """
     # set default output file name
     if args.output is None:
         args.output = "shardindex.json"
@@ -118,27 +191,11 @@ def main_create(args):
     for f in args.files:
         fnames.extend(braceexpand.braceexpand(f))
 
-    # create the shard index
-    downloader = wids_dl.SimpleDownloader()
-    files = []
-    for fname in fnames:
-        print(fname)
-        downloaded = downloader.download(fname, "/tmp/shard.tar")
-        md5sum = wids.compute_file_md5sum(downloaded)
-        nsamples = wids.compute_num_samples(downloaded)
-        filesize = os.stat(downloaded).st_size
-        files.append(
-            dict(url=fname, md5sum=md5sum, nsamples=nsamples, filesize=filesize)
-        )
-        downloader.release(downloaded)
-
-    files = sorted(files, key=lambda x: x["url"])
-
     # create the result dictionary
     result = dict(
         __kind__="wids-shard-index-v1",
         wids_version=1,
-        shardlist=files,
+        shardlist=[],
     )
 
     if args.name != "":
@@ -152,9 +209,48 @@ def main_create(args):
         info = open(args.info).read()
         result["info"] = info
 
+    # resume from a checkpoint of an interrupted run
+    done = {}
+    if not args.restart and os.path.exists(args.output):
+        with open(args.output) as f:
+            previous = json.load(f)
+        if previous.get("partial"):
+            done = {shard["url"]: shard for shard in previous["shardlist"]}
+            print(f"resuming with {len(done)} shards already indexed")
+    todo = [fname for fname in fnames if fname not in done]
+    if args.index_dir is not None:
+        os.makedirs(args.index_dir, exist_ok=True)
+
+    def checkpoint(partial):
+        result["shardlist"] = sorted(done.values(), key=lambda x: x["url"])
+        if partial:
+            result["partial"] = True
+        else:
+            result.pop("partial", None)
+        write_json_atomic(args.output, result)
+
+    # create the shard index
+    failed = []
+    last_checkpoint = time.time()
+    with ProcessPoolExecutor(args.jobs) as executor:
+        futures = {executor.submit(index_shard, fname, args.tmpdir, args.index_dir): fname for fname in todo}
+        for count, future in enumerate(as_completed(futures), 1):
+            fname = futures[future]
+            try:
+                done[fname] = future.result()
+                print(f"[{count}/{len(todo)}]", fname)
+            except Exception as exn:
+                failed.append(fname)
+                print(f"[{count}/{len(todo)}]", fname, "FAILED:", repr(exn), file=sys.stderr)
+            if time.time() - last_checkpoint > args.checkpoint:
+                checkpoint(partial=True)
+                last_checkpoint = time.time()
+
     # write the result
-    with open(args.output, "w") as f:
-        json.dump(result, f, indent=2)
+    checkpoint(partial=len(failed) > 0)
+    if failed:
+        print(f"{len(failed)} shards failed; rerun to retry them", file=sys.stderr)
+        return 1
 
 
 def main_update(args):
@@ -287,6 +383,21 @@ def main():
         "--info", "-i", help="description for dataset", default=None
     )
     create_parser.add_argument("--base", "-b", help="base path", default=None)
+    create_parser.add_argument(
+        "--jobs", "-j", type=int, default=os.cpu_count(), help="number of shards indexed in parallel"
+    )
+    create_parser.add_argument(
+        "--checkpoint", type=float, default=30.0, help="seconds between checkpoints of the output file"
+    )
+    create_parser.add_argument(
+        "--restart", action="store_true", help="ignore a checkpoint left by an interrupted run"
+    )
+    create_parser.add_argument(
+        "--tmpdir", default=None, help="directory for downloading remote shards"
+    )
+    create_parser.add_argument(
+        "--index-dir", default=None, help="write the sidecar indexes of remote shards to this directory"
+    )
 
     # Create the parser for the "update" command
     update_parser = subparsers.add_parser("update", help="Update an existing file")
@@ -350,7 +461,7 @@ def main():
     except AttributeError:
         parser.print_help()
 
-    func(args)
+    sys.exit(func(args))
 
 
 if __name__ == "__main__":
@@ -5,6 +5,10 @@ import mmap
 import os
 import struct
 
+import numpy as np
+
+from .wids_tarindex import load_or_build_tar_index, pin_index, remove_index_file, unpin_index
+
 TarHeader = collections.namedtuple(
     "TarHeader",
     [
@@ -44,6 +48,222 @@ def next_header(offset, header):
     return offset + block_size + padded_file_size
 
 
+def scan_tar_headers_loop(buffer):
+    """Index the regular files in a tar buffer by parsing one header at a time.
+
+    This is the reference implementation for `scan_tar_headers`. It returns
+    lists of member names, data offsets and sizes.
+    """
+    names, offsets, sizes = [], [], []
+    offset = 0
+    while offset >= 0 and offset < len(buffer):
+        header = parse_tar_header(buffer[offset : offset + 500])
+        name = header.name.decode("utf-8").strip("\x00")
+        typeflag = header.typeflag.decode("utf-8").strip("\x00")
+        if name != "" and name != "././@PaxHeader" and typeflag in ["0", ""]:
+            try:
+                size = int(header.size.decode("utf-8")[:-1], 8)
+            except ValueError as exn:
+                print(header)
+                raise exn
+            names.append(name)
+            offsets.append(offset + 512)
+            sizes.append(size)
+        offset = next_header(offset, header)
+    return names, offsets, sizes
+
+
+BLOCK_SIZE = 512
+# typeflags of headers whose payload describes the member that follows
+_EXTENSION_TYPES = {ord("x"), ord("g"), ord("L"), ord("K")}
+_REGULAR_TYPES = {ord("0"), 0}
+_USTAR_MAGIC = np.frombuffer(b"ustar\x00", dtype=np.uint8)
+
+
+def parse_octal_fields(fields):
+    """Parse an (n, width) uint8 array of NUL/space terminated octal fields.
+
+    Leading spaces are skipped and parsing stops at the first non-digit after
+    the number. Fields using the GNU base-256 encoding are decoded one by one.
+    """
+    if len(fields) < 8:
+        # numpy call overhead dominates for a handful of headers
+        return np.array([_parse_octal(field.tobytes()) for field in fields], dtype=np.int64)
+    value = np.zeros(len(fields), dtype=np.int64)
+    started = np.zeros(len(fields), dtype=bool)
+    done = np.zeros(len(fields), dtype=bool)
+    columns = fields.T.astype(np.int64)
+    for c in columns:
+        digit = (c >= 48) & (c <= 55)
+        value = np.where(digit & ~done, value * 8 + (c - 48), value)
+        started |= digit
+        done |= started & ~digit
+    for row in np.flatnonzero(fields[:, 0] == 0x80):
+        value[row] = _parse_base256(fields[row].tobytes())
+    return value
+
+
+def _parse_base256(field):
+    value = int.from_bytes(field[1:], "big")
+    return value if value < 2**63 else 0
+
+
+def _parse_octal(field):
+    # blocks that turn out to be member data may hold anything, so never raise
+    if field[0] == 0x80:
+        return _parse_base256(field)
+    field = field.split(b"\x00", 1)[0].strip()
+    try:
+        return int(field, 8) if field else 0
+    except ValueError:
+        return 0
+
+
+def _decode_fixed(fields):
+    """Decode an (n, width) uint8 array of NUL padded strings."""
+    fields = np.ascontiguousarray(fields)
+    return [x.decode("utf-8") for x in fields.view(f"S{fields.shape[1]}").ravel().tolist()]
+
+
+def _parse_pax(payload):
+    records = {}
+    pos = 0
+    while pos < len(payload):
+        space = payload.index(b" ", pos)
+        length = int(payload[pos:space])
+        if length <= 0:
+            break
+        key, _, value = payload[space + 1 : pos + length - 1].partition(b"=")
+        records[key.decode("utf-8")] = value.decode("utf-8")
+        pos += length
+    return records
+
+
+def _header_name(header):
+    name = header[0:100].split(b"\x00", 1)[0].decode("utf-8")
+    if header[257:263] == b"ustar\x00" and header[345] != 0:
+        name = header[345:500].split(b"\x00", 1)[0].decode("utf-8") + "/" + name
+    return name
+
+
+def _read_extension(buffer, block, typeflag, size, pending):
+    """Apply the GNU long name or PAX header at `block` to the pending overrides."""
+    start = (block + 1) * BLOCK_SIZE
+    payload = bytes(buffer[start : start + size])
+    if typeflag == ord("x"):
+        records = _parse_pax(payload)
+        pending = {}
+        if "path" in records:
+            pending["name"] = records["path"]
+        if "size" in records:
+            pending["size"] = int(records["size"])
+    elif typeflag == ord("L"):
+        pending = dict(pending, name=payload.split(b"\x00", 1)[0].decode("utf-8"))
+    return pending
+
+
+def scan_tar_headers(buffer, max_window=4096, dense_stride=8):
+    """Index the regular files in a tar buffer, parsing headers in batches.
+
+    The buffer (typically an mmap) is viewed as an array of 512 byte blocks.
+    Where members are small, blocks are processed in windows starting at the
+    next header: the size fields, type flags and names of all blocks in the
+    window are parsed with numpy, and only the hop from one header to the
+    next is done in Python. Where members average more than `dense_stride`
+    blocks, batching would mostly parse member data, so headers are read one
+    at a time instead and the data of large members is never touched.
+
+    GNU long names (L) and PAX path/size records (x) are applied to the
+    member that follows them; ustar name prefixes are honored.
+
+    With `max_window=0`, headers are always read one at a time through
+    slicing; `buffer` then only needs `len()` and slicing, which lets the
+    scanner walk remote shards (see `wids_remote`).
+
+    Returns the same (names, offsets, sizes) as `scan_tar_headers_loop`.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8) if max_window > 0 else None
+    nblocks = len(buffer) // BLOCK_SIZE
+    names, offsets, sizes = [], [], []
+
+    def add(name, block, size):
+        if name != "" and name != "././@PaxHeader":
+            names.append(name)
+            offsets.append((block + 1) * BLOCK_SIZE)
+            sizes.append(size)
+
+    pending = {}
+    window = min(64, max_window)
+    pos = 0
+    while pos < nblocks:
+        if window == 0:
+            # sparse region: step through a few headers one at a time
+            start, visited = pos, 0
+            while pos < nblocks and visited < 64:
+                header = bytes(buffer[pos * BLOCK_SIZE : (pos + 1) * BLOCK_SIZE])
+                typeflag = header[156]
+                if header[0] == 0 and typeflag == 0 and not any(header):
+                    return names, offsets, sizes
+                visited += 1
+                size = pending.get("size", _parse_octal(header[124:136]))
+                if typeflag in _EXTENSION_TYPES:
+                    pending = _read_extension(buffer, pos, typeflag, size, pending)
+                else:
+                    if typeflag in _REGULAR_TYPES:
+                        add(pending.get("name", None) or _header_name(header), pos, size)
+                    pending = {}
+                pos += 1 + (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+            if max_window > 0 and pos - start <= visited * dense_stride:
+                window = min(64, max_window)
+            continue
+
+        hi = min(pos + window, nblocks)
+        blocks = data[pos * BLOCK_SIZE : hi * BLOCK_SIZE].reshape(-1, BLOCK_SIZE)
+        block_sizes = parse_octal_fields(blocks[:, 124:136]).tolist()
+        typeflags = blocks[:, 156].tolist()
+        first_bytes = blocks[:, 0].tolist()
+
+        rows, row_sizes, row_overrides = [], [], []
+        visited = 0
+        finished = False
+        i = pos
+        while i < hi:
+            j = i - pos
+            if first_bytes[j] == 0 and typeflags[j] == 0 and not blocks[j].any():
+                finished = True
+                break
+            visited += 1
+            size = pending.get("size", block_sizes[j])
+            typeflag = typeflags[j]
+            if typeflag in _EXTENSION_TYPES:
+                pending = _read_extension(buffer, i, typeflag, size, pending)
+            else:
+                if typeflag in _REGULAR_TYPES:
+                    rows.append(j)
+                    row_sizes.append(size)
+                    row_overrides.append(pending.get("name"))
+                pending = {}
+            i += 1 + (size + BLOCK_SIZE - 1) // BLOCK_SIZE
+
+        if rows:
+            headers = blocks[rows]
+            batch_names = _decode_fixed(headers[:, 0:100])
+            has_prefix = (headers[:, 257:263] == _USTAR_MAGIC).all(axis=1) & (headers[:, 345] != 0)
+            for k in np.flatnonzero(has_prefix).tolist():
+                batch_names[k] = _decode_fixed(headers[k : k + 1, 345:500])[0] + "/" + batch_names[k]
+            for j, size, name, override in zip(rows, row_sizes, batch_names, row_overrides):
+                add(override or name, pos + j, size)
+
+        if finished:
+            break
+        if i - pos > visited * dense_stride:
+            window = 0
+        else:
+            window = min(window * 8, max_window)
+        pos = i
+    return names, offsets, sizes
+
+
 # TODO(ligeng): support gzip stream
 class MMIndexedTar:
     def __init__(self, fname, index_file=None, verbose=True, cleanup_callback=None):
@@ -58,34 +278,44 @@ class MMIndexedTar:
         self.mmapped_file = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
         if cleanup_callback:
             cleanup_callback(fname, self.stream.fileno(), "start")
-        self._build_index()
+        if callable(index_file):
+            index_file = index_file(self.fname) if self.fname is not None else None
+        self.index_file = index_file
+        index = load_or_build_tar_index(self.index_file, self.stream.fileno(), lambda: scan_tar_headers(self.mmapped_file))
+        self._names, self.offsets, self.sizes = index["names"], index["offsets"], index["sizes"]
+        self.groups = index["groups"]
+        # shared-memory indexes live as long as some process has the shard open
+        self.index_pin = pin_index(self.index_file)
 
     def close(self, dispose=False):
         if self.cleanup_callback:
             self.cleanup_callback(self.fname, self.stream.fileno(), "end")
-        self.mmapped_file.close()
+        unpin_index(self.index_file, self.index_pin)
+        self.index_pin = None
+        try:
+            self.mmapped_file.close()
+        except BufferError:
+            # zero-copy views of members are still alive; the mapping goes
+            # away together with the last of them
+            pass
         self.stream.close()
 
-    def _build_index(self):
-        self.by_name = {}
-        self.by_index = []
-        offset = 0
-        while offset >= 0 and offset < len(self.mmapped_file):
-            header = parse_tar_header(self.mmapped_file[offset : offset + 500])
-            name = header.name.decode("utf-8").strip("\x00")
-            typeflag = header.typeflag.decode("utf-8").strip("\x00")
-            if name != "" and name != "././@PaxHeader" and typeflag in ["0", ""]:
-                try:
-                    size = int(header.size.decode("utf-8")[:-1], 8)
-                except ValueError as exn:
-                    print(header)
-                    raise exn
-                self.by_name[name] = offset
-                self.by_index.append((name, offset, size))
-            offset = next_header(offset, header)
+    @property
+    def by_index(self):
+        """List of (name, header offset, size) triples, built on demand."""
+        if not hasattr(self, "_by_index"):
+            self._by_index = list(zip(self._names, (self.offsets - 512).tolist(), self.sizes.tolist()))
+        return self._by_index
+
+    @property
+    def by_name(self):
+        """Mapping from member name to header offset, built on demand."""
+        if not hasattr(self, "_by_name"):
+            self._by_name = dict(zip(self._names, (self.offsets - 512).tolist()))
+        return self._by_name
 
     def names(self):
-        return self.by_name.keys()
+        return self._names
 
     def get_at_offset(self, offset):
         header = parse_tar_header(self.mmapped_file[offset : offset + 500])
@@ -95,16 +325,16 @@ class MMIndexedTar:
         return name, self.mmapped_file[start:end]
 
     def get_at_index(self, index):
-        name, offset, size = self.by_index[index]
-        return self.get_at_offset(offset)
+        start = int(self.offsets[index])
+        return self._names[index], self.mmapped_file[start : start + int(self.sizes[index])]
 
     def get_by_name(self, name):
         offset = self.by_name[name]
         return self.get_at_offset(offset)
 
     def __iter__(self):
-        for name, offset, size in self.by_index:
-            yield name, self.mmapped_file[offset + 512 : offset + 512 + size]
+        for i in range(len(self)):
+            yield self.get_at_index(i)
 
     def __getitem__(self, key):
         if isinstance(key, int):
@@ -113,12 +343,95 @@ class MMIndexedTar:
             return self.get_by_name(key)
 
     def __len__(self):
-        return len(self.by_index)
+        return len(self._names)
 
     def get_file(self, i):
         fname, data = self.get_at_index(i)
         return fname, io.BytesIO(data)
 
+    def get_view(self, i):
+        """Return the name and a read-only memoryview of member i without copying."""
+        start = int(self.offsets[i])
+        return self._names[i], memoryview(self.mmapped_file)[start : start + int(self.sizes[i])]
+
+
+class MemoryViewIO(io.BufferedIOBase):
+    """A read-only, seekable file object over a buffer.
+
+    This behaves like `io.BytesIO` but does not copy the buffer. `getbuffer()`
+    returns the underlying memoryview, so decoders that accept bytes-like
+    objects can work on the data in place.
+    """
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def getbuffer(self):
+        self._checkClosed()
+        return self._view
+
+    def getvalue(self):
+        self._checkClosed()
+        return self._view.tobytes()
+
+    def read(self, size=-1):
+        self._checkClosed()
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        data = self._view[self._pos : end].tobytes()
+        self._pos = max(self._pos, end)
+        return data
+
+    read1 = read
+
+    def readinto(self, b):
+        self._checkClosed()
+        target = memoryview(b).cast("B")
+        n = max(0, min(len(target), len(self._view) - self._pos))
+        target[:n] = self._view[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    readinto1 = readinto
+
+    def readline(self, size=-1):
+        self._checkClosed()
+        end = len(self._view) if size is None or size < 0 else min(self._pos + size, len(self._view))
+        pos = self._pos
+        while pos < end:
+            chunk = self._view[pos : min(pos + 4096, end)].tobytes()
+            newline = chunk.find(b"\n")
+            if newline >= 0:
+                end = pos + newline + 1
+                break
+            pos += len(chunk)
+        return self.read(end - self._pos)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        self._checkClosed()
+        return self._pos
+
 
 def keep_while_reading(fname, fd, phase, delay=0.0):
     """This is a possible cleanup callback for cleanup_callback of MIndexedTar.
@@ -141,6 +454,7 @@ def keep_while_reading(fname, fd, phase, delay=0.0):
         try:
             fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
             os.unlink(fname)
+            remove_index_file(fname)
         except FileNotFoundError:
             # someone else deleted it already
             pass
@@ -149,3 +463,19 @@ def keep_while_reading(fname, fd, phase, delay=0.0):
             pass
     else:
         raise ValueError(f"Unknown phase {phase}")
+
+
+def pin_while_reading(fname, fd, phase):
+    """A cleanup callback that protects a file from eviction while it is read.
+
+    Like `keep_while_reading`, this holds a shared lock while the file is
+    open, but it never deletes the file when reading ends.
+    """
+    if fd < 0 or fname is None:
+        return
+    if phase == "start":
+        fcntl.flock(fd, fcntl.LOCK_SH)
+    elif phase == "end":
+        pass
+    else:
+        raise ValueError(f"Unknown phase {phase}")
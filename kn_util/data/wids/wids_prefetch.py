@@ -0,0 +1,151 @@
+"""
+Lookahead prefetching of shards for ShardListDataset.
+
+Shard-aware samplers know the order in which shards will be visited. When a
+dataset has a `ShardPrefetcher`, the samplers report the ranges they are
+about to iterate over, and the prefetcher downloads and indexes the next few
+shards in a background thread pool while the current one is being consumed.
+
+Prefetching runs in the process that iterates the sampler (the DataLoader
+main process). Its results are shared with DataLoader workers through the
+filesystem: the downloaded shard in the cache directory and its sidecar
+index. A worker opening a prefetched shard therefore neither downloads nor
+rescans it.
+"""
+
+import os
+import threading
+
+import numpy as np
+from loguru import logger
+
+from .wids_dl import download_and_open
+from .wids_mmtar import MMIndexedTar
+from .wids_tarindex import is_shm_index
+from .wids_utils import get_executor
+
+
+class ShardPrefetcher:
+    """Download and index the shards a sampler will visit next.
+
+    Args:
+        dataset: the ShardListDataset whose shards are prefetched
+        depth: number of shards to prefetch beyond the current one
+        num_workers: number of concurrent downloads
+        max_bytes: upper bound on the total size of the prefetched shards
+            ahead of the current one (uses the `filesize` of the shard
+            descriptors when available)
+    """
+
+    def __init__(self, dataset, depth=2, num_workers=2, max_bytes=None):
+        self.dataset = dataset
+        self.depth = depth
+        self.num_workers = num_workers
+        self.max_bytes = max_bytes
+        self.futures = {}
+        self.submitted = 0
+        self.failed = 0
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.update(futures={}, _pid=None, _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def executor(self):
+        # futures of a forked parent are never completed in this process
+        if self._pid != os.getpid():
+            self.futures = {}
+            self._pid = os.getpid()
+        return get_executor("wids-prefetch", self.num_workers)
+
+    def shards_of_range(self, lo, hi):
+        """Return the indexes of the shards overlapping the sample range [lo, hi)."""
+        cum_lengths = self.dataset.cum_lengths
+        first = int(np.searchsorted(cum_lengths, lo, side="right"))
+        last = int(np.searchsorted(cum_lengths, max(lo, hi - 1), side="right"))
+        return range(first, min(last, len(cum_lengths) - 1) + 1)
+
+    def update(self, upcoming):
+        """Prefetch the shards after the current one.
+
+        `upcoming` is an iterable of the (lo, hi) sample ranges the sampler
+        will iterate over next, starting with the current one.
+        """
+        wanted = []
+        for lo, hi in upcoming:
+            for shard_idx in self.shards_of_range(lo, hi):
+                if len(wanted) > self.depth:
+                    break
+                if shard_idx not in wanted:
+                    wanted.append(shard_idx)
+            if len(wanted) > self.depth:
+                break
+        total = 0
+        for shard_idx in wanted[1 : self.depth + 1]:
+            total += self.dataset.shards.get(shard_idx, "filesize", 0)
+            if self.max_bytes is not None and total > self.max_bytes:
+                break
+            self.submit(self.dataset.get_shard_url(shard_idx))
+        # forget finished prefetches that are no longer ahead of us
+        urls = {self.dataset.get_shard_url(shard_idx) for shard_idx in wanted}
+        with self._lock:
+            for url, future in list(self.futures.items()):
+                if url not in urls and future.done():
+                    del self.futures[url]
+
+    def submit(self, url):
+        executor = self.executor()
+        with self._lock:
+            if url in self.futures:
+                return
+            self.futures[url] = executor.submit(self.fetch, url)
+            self.submitted += 1
+
+    def fetch(self, url):
+        """Download a shard into the cache and write its sidecar index."""
+        cache = self.dataset.cache
+        local = cache.localname(url)
+        try:
+            stream = download_and_open(url, local)
+            if self.dataset.disk_cache is not None and stream.name != url:
+                self.dataset.disk_cache.touch(local)
+            index_file = cache.index_file
+            if callable(index_file):
+                index_file = index_file(stream.name)
+            # shared-memory indexes are deleted when no process has the shard
+            # open, so there is no point in building them ahead of time
+            if index_file is not None and not is_shm_index(index_file):
+                MMIndexedTar(stream, index_file=index_file).close()
+            stream.close()
+        except Exception as exn:
+            self.failed += 1
+            logger.warning(f"Prefetching {url} failed: {exn}")
+
+    def wait(self, url):
+        """Wait for a prefetch of `url` started by this process, if any.
+
+        Returns True if such a prefetch was still running.
+        """
+        if self._pid != os.getpid():
+            return False
+        with self._lock:
+            future = self.futures.get(url)
+        if future is None or future.done():
+            return False
+        future.result()
+        return True
+
+    def close(self):
+        # the thread pool is shared, so only the prefetches of this prefetcher are cancelled
+        if self._pid == os.getpid():
+            with self._lock:
+                for future in self.futures.values():
+                    future.cancel()
+        self.futures = {}
+        self._pid = None
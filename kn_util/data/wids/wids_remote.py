@@ -0,0 +1,217 @@
+"""
+Random access to remote tar shards with HTTP Range requests.
+
+Instead of downloading a whole shard, `RemoteIndexedTar` fetches only the
+byte ranges of the members that are actually read. This is useful when only
+a few samples of each shard are needed, e.g. for evaluation subsets of large
+remote datasets.
+
+The member offsets come from a sidecar index (see `wids_tarindex`). It is
+looked up in the local index location first, then fetched from next to the
+shard on the server (`<shard>.widx`), and only as a last resort built by
+walking the tar headers remotely, which for shards of small members reads
+most of the shard.
+
+Reads go through a small LRU cache of fixed size blocks, and runs of missing
+blocks are fetched with a single request, so that the members of a sample,
+which are adjacent in the shard, cost one round trip.
+"""
+
+import collections
+import io
+import os
+import threading
+
+import numpy as np
+
+from .wids_dl import download_file_no_log, http_read_range, http_size
+from .wids_mmtar import scan_tar_headers
+from .wids_tarindex import group_members, load_tar_index, pin_index, save_tar_index, sibling_index_file, unpin_index
+
+
+class HTTPRangeFile:
+    """A read-only, block cached view of a remote file.
+
+    Slicing returns bytes, which is all `scan_tar_headers` needs with
+    `max_window=0`.
+
+    Args:
+        url: http(s) url of a file on a server that supports Range requests
+        block_size: granularity of requests and of the cache
+        cache_blocks: number of blocks kept in the cache
+    """
+
+    def __init__(self, url, block_size=1 << 20, cache_blocks=64):
+        self.url = self.name = url
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.size = http_size(url)
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        assert isinstance(key, slice) and key.step is None
+        lo, hi, _ = key.indices(self.size)
+        return self.read(lo, hi)
+
+    def _fetch(self, first, last):
+        bs = self.block_size
+        data = http_read_range(self.url, first * bs, min((last + 1) * bs, self.size))
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def read(self, lo, hi):
+        """Return bytes [lo, hi) of the file."""
+        hi = min(hi, self.size)
+        if lo >= hi:
+            return b""
+        bs = self.block_size
+        first, last = lo // bs, (hi - 1) // bs
+        with self.lock:
+            blocks = {}
+            for k in range(first, last + 1):
+                if k in self.cache:
+                    self.cache.move_to_end(k)
+                    blocks[k] = self.cache[k]
+        # fetch each run of missing blocks with one request
+        k = first
+        while k <= last:
+            if k in blocks:
+                k += 1
+                continue
+            end = k
+            while end < last and end + 1 not in blocks:
+                end += 1
+            data = self._fetch(k, end)
+            if k == first and end == last:
+                # the whole range in one piece; only cache its last blocks
+                # so that large members do not flush the cache
+                self._insert(max(first, last - self.cache_blocks + 1), last, first, data)
+                return data[lo - first * bs : hi - first * bs]
+            view = memoryview(data)
+            for j in range(k, end + 1):
+                blocks[j] = view[(j - k) * bs : (j - k + 1) * bs]
+            self._insert(k, end, k, data)
+            k = end + 1
+        data = b"".join(blocks[k] for k in range(first, last + 1))
+        return data[lo - first * bs : hi - first * bs]
+
+    def _insert(self, lo, hi, base, data):
+        bs = self.block_size
+        with self.lock:
+            for k in range(lo, hi + 1):
+                self.cache[k] = bytes(data[(k - base) * bs : (k - base + 1) * bs])
+                self.cache.move_to_end(k)
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+
+    def close(self):
+        self.cache.clear()
+        self.closed = True
+
+
+class RemoteIndexedTar:
+    """Read members of a remote tar shard by index, fetching only their bytes.
+
+    This has the reader interface used by `IndexedTarSamples` (`names`,
+    `groups`, `get_file`, `get_view`).
+
+    Args:
+        url: http(s) url of the shard
+        index_file: local path of the sidecar index; a valid index there is
+            used directly, otherwise one is fetched from the server or built
+            and saved there
+        remote_index: try fetching `<url>.widx` from the server
+        block_size, cache_blocks: see `HTTPRangeFile`
+    """
+
+    def __init__(self, url, index_file=None, remote_index=True, block_size=1 << 20, cache_blocks=64):
+        self.url = url
+        self.file = HTTPRangeFile(url, block_size=block_size, cache_blocks=cache_blocks)
+        self.index_file = index_file
+        # remote indexes are built elsewhere, so only the size can be checked
+        stat = dict(shard_size=len(self.file))
+        index = load_tar_index(index_file, stat=stat)
+        if index is None and remote_index and index_file is not None:
+            index = self._fetch_index(stat)
+        if index is None:
+            names, offsets, sizes = scan_tar_headers(self.file, max_window=0)
+            self._names = names
+            self.offsets = np.array(offsets, dtype=np.int64)
+            self.sizes = np.array(sizes, dtype=np.int64)
+            self.groups = group_members(names)
+            save_tar_index(index_file, None, names, self.offsets, self.sizes, self.groups, stat=stat)
+        else:
+            self._names, self.offsets, self.sizes = index["names"], index["offsets"], index["sizes"]
+            self.groups = index["groups"]
+        # shared-memory indexes are deleted when their last reader closes them
+        self.index_pin = pin_index(index_file)
+        self.loaded = {}
+
+    def _fetch_index(self, stat):
+        import httpx
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+        try:
+            download_file_no_log(sibling_index_file(self.url), self.index_file)
+        except httpx.HTTPStatusError:
+            return None
+        return load_tar_index(self.index_file, stat=stat)
+
+    def names(self):
+        return self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    def load_members(self, indexes):
+        """Fetch the data of several members ahead of reading them.
+
+        Members are read in offset order and members separated by less than
+        a block are fetched together, so a sample (or a batch of samples)
+        needs as few requests as possible. The data is handed out by the
+        next `get_file`/`get_view` of each member.
+        """
+        indexes = np.unique(np.asarray(indexes, dtype=np.int64))
+        indexes = indexes[[i not in self.loaded for i in indexes.tolist()]]
+        if len(indexes) == 0:
+            return
+        starts = self.offsets[indexes]
+        ends = starts + self.sizes[indexes]
+        order = np.argsort(starts, kind="stable")
+        indexes, starts, ends = indexes[order], starts[order], ends[order]
+        # split into runs where the gap to the previous member exceeds a block
+        breaks = np.flatnonzero(starts[1:] - np.maximum.accumulate(ends)[:-1] > self.file.block_size) + 1
+        for run in np.split(np.arange(len(indexes)), breaks):
+            lo, hi = int(starts[run[0]]), int(ends[run].max())
+            view = memoryview(self.file.read(lo, hi))
+            for i in run.tolist():
+                self.loaded[int(indexes[i])] = view[int(starts[i]) - lo : int(ends[i]) - lo]
+
+    def get_view(self, i):
+        data = self.loaded.pop(i, None)
+        if data is None:
+            start = int(self.offsets[i])
+            data = memoryview(self.file.read(start, start + int(self.sizes[i])))
+        return self._names[i], data
+
+    def get_at_index(self, i):
+        name, data = self.get_view(i)
+        return name, bytes(data)
+
+    def get_file(self, i):
+        name, data = self.get_view(i)
+        return name, io.BytesIO(data)
+
+    def close(self):
+        self.loaded.clear()
+        self.file.close()
+        unpin_index(self.index_file, self.index_pin)
+        self.index_pin = None
@@ -0,0 +1,126 @@
+"""
+Compact, array-backed storage of the shard list of a ShardListDataset.
+
+A list of one dict per shard costs several hundred bytes per shard, is
+pickled into every DataLoader worker and, since reading it touches Python
+refcounts, gets copied page by page into forked workers. `ShardTable` keeps
+the same information in a handful of objects: url basenames as one utf-8
+blob with offsets, numeric fields as numpy arrays, and url directories and
+other repeated strings (such as the dataset name) as ids into lists of
+distinct values. Shard descriptors are built as dicts only when asked for.
+"""
+
+import numpy as np
+
+# numeric fields and the value that marks them as missing
+_NUMERIC = dict(nsamples=(np.int64, None), filesize=(np.int64, -1), weight=(np.float64, np.nan))
+# string fields with few distinct values
+_CATEGORICAL = ("dataset", "name", "source_url")
+
+
+class ShardTable:
+    """The shards of a dataset, stored column-wise.
+
+    Indexing returns a descriptor dict like the ones in the shard list the
+    table was built from, with urls already resolved by `resolve`. Use
+    `url(i)` and `get(i, key)` to look up single fields without building the
+    dict, and the `nsamples`, `filesize` and `weight` arrays or `ids(key)`/
+    `values(key)` for whole columns.
+
+    Args:
+        shards: list of shard descriptors, each with at least url and nsamples
+        resolve: optional function applied to every url
+    """
+
+    def __init__(self, shards, resolve=None):
+        urls = [shard["url"] if resolve is None else resolve(shard["url"]) for shard in shards]
+        # urls are stored as an id into the distinct directory prefixes plus
+        # the basename, which goes into one blob
+        prefixes = {}
+        self.url_prefix_ids = np.empty(len(urls), dtype=np.int32)
+        encoded = []
+        for i, url in enumerate(urls):
+            slash = url.rfind("/") + 1
+            self.url_prefix_ids[i] = prefixes.setdefault(url[:slash], len(prefixes))
+            encoded.append(url[slash:].encode("utf-8"))
+        self.url_prefixes = list(prefixes)
+        self.url_blob = b"".join(encoded)
+        self.url_offsets = np.concatenate([[0], np.cumsum([len(name) for name in encoded], dtype=np.int64)]).astype(np.int64)
+        for key, (dtype, missing) in _NUMERIC.items():
+            column = [shard[key] if missing is None else shard.get(key) for shard in shards]
+            column = [missing if value is None else value for value in column]
+            setattr(self, key, np.array(column, dtype=dtype))
+        self.categories = {}
+        for key in _CATEGORICAL:
+            values = {}
+            ids = np.array([-1 if shard.get(key) is None else values.setdefault(shard[key], len(values)) for shard in shards], dtype=np.int32)
+            if values:
+                self.categories[key] = (list(values), ids)
+        # any other fields, which are rare, are kept sparsely
+        known = {"url", *_NUMERIC, *_CATEGORICAL}
+        self.extras = {}
+        for i, shard in enumerate(shards):
+            for key, value in shard.items():
+                if key not in known:
+                    self.extras.setdefault(key, {})[i] = value
+
+    def __len__(self):
+        return len(self.nsamples)
+
+    def _index(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"shard index {i} out of range for {n} shards")
+        return i
+
+    def url(self, i):
+        i = self._index(i)
+        basename = self.url_blob[self.url_offsets[i] : self.url_offsets[i + 1]].decode("utf-8")
+        return self.url_prefixes[self.url_prefix_ids[i]] + basename
+
+    def ids(self, key):
+        """Return the per-shard ids of a string field (-1 where missing)."""
+        if key not in self.categories:
+            return np.full(len(self), -1, dtype=np.int32)
+        return self.categories[key][1]
+
+    def values(self, key):
+        """Return the distinct values of a string field, indexed by `ids(key)`."""
+        return self.categories[key][0] if key in self.categories else []
+
+    def get(self, i, key, default=None):
+        """Return a single field of shard i."""
+        i = self._index(i)
+        if key == "url":
+            return self.url(i)
+        if key in _NUMERIC:
+            value = getattr(self, key)[i]
+            missing = _NUMERIC[key][1]
+            if missing is not None and (value == missing or value != value):
+                return default
+            return value.item()
+        if key in self.categories:
+            values, ids = self.categories[key]
+            return values[ids[i]] if ids[i] >= 0 else default
+        return self.extras.get(key, {}).get(i, default)
+
+    def __getitem__(self, i):
+        i = self._index(i)
+        desc = dict(url=self.url(i))
+        for key in (*_NUMERIC, *_CATEGORICAL):
+            value = self.get(i, key)
+            if value is not None:
+                desc[key] = value
+        for key, values in self.extras.items():
+            if i in values:
+                desc[key] = values[i]
+        return desc
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return f"<ShardTable {len(self)} shards, {int(self.nsamples.sum())} samples>"
@@ -1,26 +1,40 @@
 import io
 import os
 import os.path
-import pickle
-import re
 import tarfile
+import threading
 
 import numpy as np
 
+from .wids_tarindex import find_index_file, load_or_build_tar_index, pin_index, unpin_index
+from .wids_utils import get_executor
 
-def find_index_file(file):
-    prefix, last_ext = os.path.splitext(file)
-    if re.match("._[0-9]+_$", last_ext):
-        return prefix + ".index"
-    else:
-        return file + ".index"
+# default number of threads of TarFileReader.get_files
+read_threads = int(os.environ.get("WIDS_READ_THREADS", 8))
+
+
+def pread_exactly(fd, size, offset):
+    """Read exactly size bytes at offset without moving the file position."""
+    data = os.pread(fd, size, offset)
+    if len(data) == size:
+        return data
+    chunks = [data]
+    got = len(data)
+    while got < size:
+        chunk = os.pread(fd, size - got, offset + got)
+        if not chunk:
+            raise EOFError(f"unexpected end of file at offset {offset + got}")
+        chunks.append(chunk)
+        got += len(chunk)
+    return b"".join(chunks)
 
 
 class TarFileReader:
     def __init__(self, file, index_file=find_index_file, verbose=True):
         self.verbose = verbose
         if callable(index_file):
-            index_file = index_file(file)
+            name = file if isinstance(file, str) else getattr(file, "name", None)
+            index_file = index_file(name) if isinstance(name, str) else None
         self.index_file = index_file
 
         # Open the tar file and keep it open
@@ -28,42 +42,43 @@ class TarFileReader:
             self.tar_file = tarfile.open(file, "r")
         else:
             self.tar_file = tarfile.open(fileobj=file, mode="r")
+        # member offsets are positions in the uncompressed stream, so they can
+        # only be pread from uncompressed files; compressed tars seek and read
+        fileobj = self.tar_file.fileobj
+        self.fd = fileobj.fileno() if isinstance(fileobj, (io.BufferedReader, io.FileIO)) else None
+        self.seek_lock = threading.Lock()
 
         # Create the index
         self._create_tar_index()
 
     def _create_tar_index(self):
-        if self.index_file is not None and os.path.exists(self.index_file):
-            if self.verbose:
-                print("Loading tar index from", self.index_file)
-            with open(self.index_file, "rb") as stream:
-                self.fnames, self.index = pickle.load(stream)
-            return
-        # Create an empty list for the index
-        self.fnames = []
-        self.index = []
+        fd = self.tar_file.fileobj.fileno()
+        self._scanned = False
+        index = load_or_build_tar_index(self.index_file, fd, self._scan_members)
+        if self.verbose and not self._scanned:
+            print("Loaded tar index from", self.index_file)
+        self.fnames = index["names"]
+        self.index = np.stack([index["offsets"], index["sizes"]], axis=1)
+        self.groups = index["groups"]
+        self.index_pin = pin_index(self.index_file)
 
+    def _scan_members(self):
+        self._scanned = True
         if self.verbose:
             print("Creating tar index for", self.tar_file.name, "at", self.index_file)
         # Iterate over the members of the tar file
+        names, offsets, sizes = [], [], []
         for member in self.tar_file:
             # If the member is a file, add it to the index
             if member.isfile():
-                # Get the file's offset
-                offset = self.tar_file.fileobj.tell()
-                self.fnames.append(member.name)
-                self.index.append([offset, member.size])
+                names.append(member.name)
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
         if self.verbose:
             print(
                 "Done creating tar index for", self.tar_file.name, "at", self.index_file
             )
-        self.index = np.array(self.index)
-        if self.index_file is not None:
-            if os.path.exists(self.index_file + ".temp"):
-                os.unlink(self.index_file + ".temp")
-            with open(self.index_file + ".temp", "wb") as stream:
-                pickle.dump((self.fnames, self.index), stream)
-            os.rename(self.index_file + ".temp", self.index_file)
+        return names, offsets, sizes
 
     def names(self):
         return self.fnames
@@ -71,13 +86,31 @@ class TarFileReader:
     def __len__(self):
         return len(self.index)
 
+    def get_at_index(self, i):
+        offset, size = self.index[i].tolist()
+        if self.fd is not None:
+            # pread leaves the shared file position alone, so this is thread-safe
+            return self.fnames[i], pread_exactly(self.fd, size, offset)
+        with self.seek_lock:
+            self.tar_file.fileobj.seek(offset)
+            data = self.tar_file.fileobj.read(size)
+        if len(data) != size:
+            raise EOFError(f"unexpected end of file at offset {offset + len(data)}")
+        return self.fnames[i], data
+
     def get_file(self, i):
-        name = self.fnames[i]
-        offset, size = self.index[i]
-        self.tar_file.fileobj.seek(offset)
-        file_bytes = self.tar_file.fileobj.read(size)
+        name, file_bytes = self.get_at_index(i)
         return name, io.BytesIO(file_bytes)
 
+    def get_files(self, indexes, num_threads=None):
+        """Read several members concurrently, returning (name, BytesIO) pairs in order."""
+        num_threads = num_threads or read_threads
+        if num_threads <= 1 or len(indexes) <= 1:
+            return [self.get_file(i) for i in indexes]
+        return list(get_executor("wids-read", num_threads).map(self.get_file, indexes))
+
     def close(self):
+        unpin_index(self.index_file, self.index_pin)
+        self.index_pin = None
         # Close the tar file
         self.tar_file.close()
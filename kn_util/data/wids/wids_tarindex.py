@@ -0,0 +1,444 @@
+"""
+Persistent sidecar indexes for tar shards.
+
+A sidecar index stores the member names, data offsets and sizes of a tar
+shard as flat numpy arrays, so that reopening a shard does not require
+walking every tar header again. The file layout is
+
+    magic (8 bytes) | header length (8 bytes, little endian) | JSON header | arrays
+
+where every array starts on a 64 byte boundary, which lets the arrays be
+memory-mapped directly. The JSON header records the size and mtime of the
+shard the index was built from; an index that does not match the shard is
+ignored and rebuilt.
+
+Indexes are opt-in: readers and datasets only use them when given an
+`index_file`, such as `find_index_file` or `shm_index_file`.
+"""
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import re
+import struct
+
+import numpy as np
+from loguru import logger
+
+INDEX_MAGIC = b"WIDSIDX1"
+INDEX_VERSION = 1
+INDEX_ALIGN = 64
+INDEX_SUFFIX = ".widx"
+# bumped whenever the set of arrays stored for tar shards changes
+TAR_INDEX_VERSION = 3
+
+
+def _align(n):
+    return (n + INDEX_ALIGN - 1) // INDEX_ALIGN * INDEX_ALIGN
+
+
+def default_index_dir():
+    """Return the directory used for indexes of shards in read-only locations."""
+    cache_dir = os.environ.get("WIDS_CACHE", "~/.cache/_wids_cache")
+    return os.path.join(os.path.expanduser(cache_dir), "_index")
+
+
+def sibling_index_file(file):
+    """Return the name of the sidecar index stored next to a shard path or url."""
+    prefix, last_ext = os.path.splitext(file)
+    if re.match("._[0-9]+_$", last_ext):
+        return prefix + INDEX_SUFFIX
+    return file + INDEX_SUFFIX
+
+
+def find_index_file(file, index_dir=None):
+    """Return the sidecar index path for a shard.
+
+    The index is placed next to the shard if it already exists there or if
+    the shard directory is writable, otherwise it goes into `index_dir`
+    (the wids cache by default) under a name derived from the shard path.
+    """
+    index_file = sibling_index_file(file)
+    if index_dir is None:
+        if os.path.exists(index_file) or os.access(os.path.dirname(os.path.abspath(index_file)), os.W_OK):
+            return index_file
+        index_dir = default_index_dir()
+    hex16 = base64.urlsafe_b64encode(hashlib.sha256(os.path.abspath(file).encode()).digest())[:16].decode()
+    return os.path.join(index_dir, hex16 + "__" + os.path.basename(index_file))
+
+
+def shm_index_dir():
+    """Return the directory for node-local shared indexes, in /dev/shm if available."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return os.path.join("/dev/shm", f"wids-index-{os.getuid()}")
+    return os.path.join(default_index_dir(), "shm")
+
+
+def shm_index_file(file):
+    """Return a shared-memory index path for a shard, keyed by its path and mtime.
+
+    This can be used as `index_file` of a ShardListDataset. All processes
+    of a node then share one index per shard version in /dev/shm, built by
+    whichever process opens the shard first. Unlike persistent sidecar
+    indexes, these are deleted when the last process that has the shard
+    open closes it (see `pin_index`).
+    """
+    key = os.path.abspath(file)
+    if os.path.exists(file):
+        st = os.stat(file)
+        key += f":{st.st_size}:{st.st_mtime_ns}"
+    key = key.encode()
+    hex16 = base64.urlsafe_b64encode(hashlib.sha256(key).digest())[:16].decode()
+    return os.path.join(shm_index_dir(), hex16 + "__" + os.path.basename(file) + INDEX_SUFFIX)
+
+
+def is_shm_index(index_file):
+    return index_file is not None and os.path.abspath(index_file).startswith(shm_index_dir() + os.sep)
+
+
+def pin_index(index_file):
+    """Register a reader of a shared-memory index; returns a handle for `unpin_index`.
+
+    Readers hold a shared lock on the index file, so the index is deleted
+    only by the last of them, as in `keep_while_reading` for shards.
+    Returns None for persistent indexes, which are never deleted.
+    """
+    if not is_shm_index(index_file):
+        return None
+    try:
+        fd = os.open(index_file, os.O_RDONLY)
+    except FileNotFoundError:
+        return None
+    fcntl.flock(fd, fcntl.LOCK_SH)
+    return fd
+
+
+def unpin_index(index_file, fd):
+    """Unregister a reader, deleting the index if it was the last one."""
+    if fd is None:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # only delete the file we pinned, not one that replaced it meanwhile
+        if os.stat(index_file).st_ino == os.fstat(fd).st_ino:
+            os.unlink(index_file)
+            remove_lock_file(index_file + ".lock")
+    except (BlockingIOError, FileNotFoundError):
+        pass
+    finally:
+        os.close(fd)
+
+
+def lock_file(path):
+    """Take an exclusive lock on `path`, creating it; returns a handle for `unlock_file`.
+
+    The lock file is deleted again by `unlock_file`, so a process that opened
+    it before the deletion may hold a lock on a file that is no longer there;
+    the lock is only taken once the locked file is the one at `path`.
+    """
+    while True:
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def unlock_file(path, fd):
+    """Release and delete a lock taken with `lock_file`."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def remove_lock_file(path):
+    """Delete a lock file left behind by a process that died holding it, unless it is in use."""
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if os.stat(path).st_ino == os.fstat(fd).st_ino:
+            os.unlink(path)
+    except (BlockingIOError, FileNotFoundError):
+        pass
+    finally:
+        os.close(fd)
+
+
+def remove_index_file(file):
+    """Delete the sidecar index of a shard that is being deleted, if any."""
+    index_file = find_index_file(file)
+    try:
+        os.unlink(index_file)
+    except FileNotFoundError:
+        pass
+    remove_lock_file(index_file + ".lock")
+
+
+def shard_stat(fd):
+    """Return the size/mtime signature of an open shard used to validate indexes."""
+    st = os.fstat(fd)
+    return dict(shard_size=st.st_size, shard_mtime_ns=st.st_mtime_ns)
+
+
+def encode_names(names):
+    """Encode a list of member names as a NUL-separated uint8 array."""
+    return np.frombuffer("\0".join(names).encode("utf-8"), dtype=np.uint8)
+
+
+def decode_names(blob):
+    """Decode a NUL-separated uint8 array back into a list of names."""
+    if len(blob) == 0:
+        return []
+    return bytes(blob).decode("utf-8").split("\0")
+
+
+def name_offsets(names):
+    """Return the start offsets of the names in their `encode_names` blob, plus the end."""
+    lengths = np.fromiter((len(name.encode("utf-8")) + 1 for name in names), dtype=np.int64, count=len(names))
+    return np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+
+class NameList:
+    """A read-only list of the names in an `encode_names` blob.
+
+    Names are decoded when accessed, so an index mapped by many processes
+    is not copied into a Python list in each of them.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"name index {i} out of range")
+        lo, hi = self.offsets[i : i + 2].tolist()
+        return bytes(self.blob[lo : hi - 1]).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def split_member_name(name):
+    """Split a member name into sample key and extension.
+
+    This is equivalent to `wids.splitname`: the extension starts at the
+    first "." after the last "/".
+    """
+    dot = name.find(".", name.rfind("/") + 1)
+    if dot < 0:
+        basename, extension = re.match(r"^((?:.*/)?.*?)(\..*)$", name).groups()
+        return basename, extension
+    return name[:dot], name[dot:]
+
+
+def group_members(names):
+    """Group tar members into samples by key, in CSR layout.
+
+    Samples are ordered by the first appearance of their key and members
+    keep their order within a sample, as in `wids.group_by_key`. Returns a
+    dictionary with
+
+        sample_order: member indexes, sorted by sample
+        sample_offsets: sample i owns sample_order[sample_offsets[i]:sample_offsets[i + 1]]
+        sample_key_lengths: length of the key of each sample
+        member_extensions: index into `extensions` for each member
+        extensions: the distinct extensions in the shard
+    """
+    keys = {}
+    extensions = {}
+    members, member_samples, key_lengths = [], [], []
+    member_extensions = np.full(len(names), -1, dtype=np.int32)
+    for i, name in enumerate(names):
+        if "." not in name:
+            logger.warning(f"Warning: Ignoring file {name} (no '.')")
+            continue
+        if name == ".":
+            logger.warning(f"Warning: Ignoring the '.' file.")
+            continue
+        key, ext = split_member_name(name)
+        sample = keys.setdefault(key, len(keys))
+        if sample == len(key_lengths):
+            key_lengths.append(len(key))
+        members.append(i)
+        member_samples.append(sample)
+        member_extensions[i] = extensions.setdefault(ext, len(extensions))
+    members = np.array(members, dtype=np.int64)
+    member_samples = np.array(member_samples, dtype=np.int64)
+    order = np.argsort(member_samples, kind="stable")
+    counts = np.bincount(member_samples, minlength=len(keys))
+    return dict(
+        sample_order=members[order],
+        sample_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+        sample_key_lengths=np.array(key_lengths, dtype=np.int64),
+        member_extensions=member_extensions,
+        extensions=list(extensions),
+    )
+
+
+def write_index(index_file, arrays, meta):
+    """Atomically write a dictionary of numpy arrays plus metadata to `index_file`."""
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = dict(dtype=array.dtype.str, shape=list(array.shape), offset=offset)
+        offset = _align(offset + array.nbytes)
+    header = json.dumps(dict(version=INDEX_VERSION, meta=meta, arrays=layout)).encode("utf-8")
+    base = _align(len(INDEX_MAGIC) + 8 + len(header))
+
+    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+    temp_file = f"{index_file}.{os.getpid()}.temp"
+    try:
+        with open(temp_file, "wb") as stream:
+            stream.write(INDEX_MAGIC)
+            stream.write(struct.pack("<Q", len(header)))
+            stream.write(header)
+            for name, array in arrays.items():
+                stream.seek(base + layout[name]["offset"])
+                stream.write(array.tobytes())
+            stream.truncate(base + offset)
+        os.replace(temp_file, index_file)
+    finally:
+        if os.path.exists(temp_file):
+            os.unlink(temp_file)
+
+
+def read_index(index_file, mmap=True):
+    """Read an index written by `write_index`.
+
+    Returns a (meta, arrays) pair. With `mmap=True` the arrays are read-only
+    views into a memory map of the index file.
+    """
+    with open(index_file, "rb") as stream:
+        if stream.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise ValueError(f"{index_file} is not a wids index")
+        (header_len,) = struct.unpack("<Q", stream.read(8))
+        header = json.loads(stream.read(header_len))
+    if header.get("version") != INDEX_VERSION:
+        raise ValueError(f"{index_file} has unknown index version {header.get('version')}")
+    base = _align(len(INDEX_MAGIC) + 8 + header_len)
+    if mmap:
+        buffer = np.memmap(index_file, dtype=np.uint8, mode="r")
+    else:
+        buffer = np.fromfile(index_file, dtype=np.uint8)
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        shape = tuple(spec["shape"])
+        start = base + spec["offset"]
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        arrays[name] = buffer[start : start + nbytes].view(dtype).reshape(shape)
+    return header["meta"], arrays
+
+
+def load_tar_index(index_file, fd=None, stat=None):
+    """Load the sidecar index for the shard open as `fd`.
+
+    For shards that are not open locally, `stat` gives the signature to
+    validate against instead (e.g. only `shard_size` for remote shards).
+
+    Returns a dictionary with `names`, `offsets`, `sizes` and the sample
+    grouping `groups` (see `group_members`), or None if there is no valid
+    index.
+    """
+    if index_file is None or not os.path.exists(index_file):
+        return None
+    try:
+        meta, arrays = read_index(index_file)
+    except (OSError, ValueError, KeyError) as exn:
+        logger.warning(f"Ignoring unreadable tar index {index_file}: {exn}")
+        return None
+    expected = dict(stat if stat is not None else shard_stat(fd), version=TAR_INDEX_VERSION)
+    if any(meta.get(k) != v for k, v in expected.items()):
+        return None
+    groups = {k: arrays[k] for k in ["sample_order", "sample_offsets", "sample_key_lengths", "member_extensions"]}
+    groups["extensions"] = decode_names(arrays["extensions"])
+    return dict(
+        names=NameList(arrays["names"], arrays["name_offsets"]),
+        offsets=arrays["offsets"],
+        sizes=arrays["sizes"],
+        groups=groups,
+    )
+
+
+def save_tar_index(index_file, fd, names, offsets, sizes, groups, stat=None):
+    """Write the sidecar index for the shard open as `fd` (or with signature `stat`).
+
+    `offsets` are the offsets of the member data (not of the tar headers),
+    `groups` is the sample grouping computed by `group_members`. Failures
+    to write are logged and otherwise ignored, since the index is only an
+    optimization.
+    """
+    if index_file is None:
+        return
+    arrays = dict(
+        names=encode_names(names),
+        name_offsets=name_offsets(names),
+        offsets=np.asarray(offsets, dtype=np.int64),
+        sizes=np.asarray(sizes, dtype=np.int64),
+        extensions=encode_names(groups["extensions"]),
+    )
+    arrays.update((k, v) for k, v in groups.items() if k != "extensions")
+    meta = dict(kind="wids-tar-index", version=TAR_INDEX_VERSION, **(stat if stat is not None else shard_stat(fd)))
+    try:
+        write_index(index_file, arrays, meta)
+    except OSError as exn:
+        logger.warning(f"Could not write tar index {index_file}: {exn}")
+
+
+def load_or_build_tar_index(index_file, fd, build):
+    """Return the index of the shard open as `fd`, building it if needed.
+
+    `build()` must return the (names, offsets, sizes) of the members. The
+    index is built under a lock next to `index_file` (see `lock_file`), so
+    that when several processes open a shard at once, one of them builds and
+    saves the index while the others wait and then load it. Returns the same
+    dictionary as `load_tar_index`.
+    """
+    index = load_tar_index(index_file, fd)
+    if index is not None:
+        return index
+    lock = None
+    if index_file is not None:
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+            lock = lock_file(index_file + ".lock")
+        except OSError:
+            lock = None
+    try:
+        if lock is not None:
+            index = load_tar_index(index_file, fd)
+            if index is not None:
+                return index
+        names, offsets, sizes = build()
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        groups = group_members(names)
+        save_tar_index(index_file, fd, names, offsets, sizes, groups)
+        return dict(names=names, offsets=offsets, sizes=sizes, groups=groups)
+    finally:
+        if lock is not None:
+            unlock_file(index_file + ".lock", lock)
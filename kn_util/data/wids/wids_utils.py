@@ -1,17 +1,124 @@
+import hashlib
+import json
+import mmap
 import os, os.path as osp
-from ...utils.multiproc import map_async_with_thread
-import webdataset as wds
-import tarfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
+from loguru import logger
 
-def get_file_lengths(files):
+from ...dist import all_gather_object, get_rank, get_world_size
+from .wids_mmtar import scan_tar_headers
+from .wids_tarindex import group_members
+
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def get_executor(name, max_workers):
+    """
+    return the thread pool `name` with `max_workers` threads of this process, creating it
+    on first use; pools are keyed by process id since their threads don't survive fork
+    """
+    key = (os.getpid(), name, max_workers)
+    with _executors_lock:
+        if key not in _executors:
+            _executors[key] = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        return _executors[key]
+
+
+def count_samples(file):
+    """
+    count the samples in a tar file by scanning its headers only; members are grouped
+    into samples by key exactly like `wids.group_by_key`
+    """
+    with open(file, "rb") as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            names, _, _ = scan_tar_headers(mapped)
+    return len(group_members(names)["sample_offsets"]) - 1
+
+
+def count_samples_parallel(files, num_workers=None, chunksize=16, threads=False):
+    """
+    count the samples of many tar files with a process pool (or a thread pool, e.g. in
+    processes that should not fork), returns the counts in order
+    """
+    files = list(files)
+    if num_workers is None:
+        num_workers = min(len(files), os.cpu_count() or 1)
+    if num_workers <= 1:
+        return [count_samples(file) for file in files]
+    if threads:
+        with ThreadPoolExecutor(num_workers) as executor:
+            return list(executor.map(count_samples, files))
+    with ProcessPoolExecutor(num_workers) as executor:
+        return list(executor.map(count_samples, files, chunksize=chunksize))
+
+
+def get_file_lengths(files, num_workers=None):
     """
     get the number of keys in each tar file, each key corresponds to a sample in WebDataset
     """
-    def _get_key_number(file):
-        with tarfile.open(file, 'r') as tar:
-            members = set([_.name.split(".")[0] for _ in tar.getmembers()])
-        
-        return file, len(members)
+    files = list(files)
+    return list(zip(files, count_samples_parallel(files, num_workers=num_workers)))
+
+
+def _file_list_key(files):
+    return hashlib.sha256("\n".join(files).encode("utf-8")).hexdigest()
+
 
-    return map_async_with_thread(iterable=files, func=_get_key_number, num_thread=None, verbose=False)
+def _load_length_cache(cache_file, key):
+    try:
+        with open(cache_file) as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_length_cache(cache_file, key, lengths):
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = lengths
+    try:
+        os.makedirs(osp.dirname(osp.abspath(cache_file)), exist_ok=True)
+        temp = f"{cache_file}.{os.getpid()}.temp"
+        with open(temp, "w") as f:
+            json.dump(cache, f)
+        os.replace(temp, cache_file)
+    except OSError as exn:
+        logger.warning(f"Could not write shard length cache {cache_file}: {exn}")
+
+
+def get_file_lengths_distributed(files, cache_file=None, num_workers=None):
+    """
+    get_file_lengths for all ranks of a distributed job: every rank counts an interleaved
+    slice of the files with a thread pool and the counts are merged with a single gather.
+    if cache_file is given, the result is stored there keyed by the list of files (not by
+    their contents) and later calls with the same list of files load it instead; rank 0
+    loads it and shares it with the other ranks
+    """
+    files = list(files)
+    key = _file_list_key(files)
+    rank, world_size = get_rank(), get_world_size()
+    if cache_file is not None:
+        # only rank 0 reads the cache and all ranks take its result, so that they
+        # all either return it or go on to count together
+        lengths = _load_length_cache(cache_file, key) if rank == 0 else None
+        lengths = all_gather_object(lengths)[0]
+        if lengths is not None:
+            return [(file, n) for file, n in zip(files, lengths)]
+    mine = files[rank::world_size]
+    counts = count_samples_parallel(mine, num_workers=num_workers, threads=True)
+    gathered = all_gather_object(counts)
+    lengths = [0] * len(files)
+    for r, rank_counts in enumerate(gathered):
+        lengths[r::world_size] = rank_counts
+    if cache_file is not None and rank == 0:
+        _save_length_cache(cache_file, key, lengths)
+    return list(zip(files, lengths))
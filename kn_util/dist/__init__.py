@@ -1,3 +1,3 @@
 from .dist import *
 from torch.distributed.elastic.multiprocessing.errors import record
-from .sampler import DistributedSampler
\ No newline at end of file
+from .sampler import DistributedSampler, LazyDistributedSampler, LazyPermutation
\ No newline at end of file
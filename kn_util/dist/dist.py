@@ -239,6 +239,10 @@ def shared_random_seed():
     return all_ints[0]
 
 
+# name used by the mmengine-derived samplers
+sync_random_seed = shared_random_seed
+
+
 def reduce_dict(input_dict, average=True):
     """
     Reduce the values in the dictionary from all processes so that process with rank
@@ -1,12 +1,15 @@
 import math
 from typing import TypeVar, Optional, Iterator
 
+import numpy as np
 import torch
 from torch.utils.data import Sampler, Dataset
 import torch.distributed as dist
 
 __all__ = [
     "DistributedSampler",
+    "LazyPermutation",
+    "LazyDistributedSampler",
 ]
 
 T_co = TypeVar("T_co", covariant=True)
@@ -92,10 +95,13 @@ class DistributedSampler(Sampler[T_co]):
         self.num_replicas = num_replicas
         self.rank = rank
         self.epoch = 0
+        self.position = 0
+        # whether the next iteration resumes at a loaded position
+        self._resume = False
         self.drop_last = drop_last
         # If the dataset length is evenly divisible by # of replicas, then there
         # is no need to drop any data, since the dataset will be split equally.
-        if self.drop_last and num_samples % self.num_replicas != 0:  # type: ignore[arg-type]
+        if self.drop_last and total_size % self.num_replicas != 0:  # type: ignore[arg-type]
             # Split to nearest available length that is evenly divisible.
             # This is to ensure each rank receives the same amount of data when
             # using this Sampler.
@@ -131,7 +137,19 @@ class DistributedSampler(Sampler[T_co]):
         indices = indices[self.rank : self.total_size : self.num_replicas]
         assert len(indices) == self.num_samples
 
-        return iter(indices)
+        return self._count(indices[self._start() :])
+
+    def _start(self) -> int:
+        if not self._resume:
+            self.position = 0
+        self._resume = False
+        return self.position
+
+    def _count(self, indices: Iterator[T_co]) -> Iterator[T_co]:
+        for index in indices:
+            self.position += 1
+            yield index
+        self.position = 0
 
     def __len__(self) -> int:
         return self.num_samples
@@ -146,3 +164,113 @@ class DistributedSampler(Sampler[T_co]):
             epoch (int): Epoch number.
         """
         self.epoch = epoch
+
+    def state_dict(self) -> dict:
+        r"""Return the epoch, seed and position of the sampler within the epoch.
+
+        ``position`` counts the indices handed out in the current epoch. A
+        :class:`DataLoader` requests indices ahead of the training loop, so
+        for an exact resume store the number of consumed samples instead.
+        """
+        return dict(epoch=self.epoch, seed=self.seed, position=self.position)
+
+    def load_state_dict(self, state: dict) -> None:
+        r"""Restore a :meth:`state_dict`; the next iteration starts at its position.
+
+        Other iterations start at the beginning of the epoch.
+        """
+        self.epoch = state["epoch"]
+        self.seed = state["seed"]
+        self.position = state["position"]
+        self._resume = True
+
+
+class LazyPermutation:
+    r"""A seeded pseudo-random permutation of ``range(n)`` computed on the fly.
+
+    Elements are computed with a balanced Feistel network over the smallest
+    power-of-4 domain containing ``n``, cycle-walking until the result falls
+    into ``[0, n)``. This is a bijection, needs constant memory and costs
+    O(1) (expected fewer than 4 network evaluations) per element.
+
+    Args:
+        n (int): size of the permuted range.
+        seed (int or sequence of ints): seed of the round keys.
+        rounds (int): number of Feistel rounds.
+    """
+
+    def __init__(self, n: int, seed=0, rounds: int = 4) -> None:
+        self.n = n
+        bits = max(2, (max(n - 1, 1)).bit_length())
+        self.half = (bits + 1) // 2
+        self.mask = np.uint64((1 << self.half) - 1)
+        self.keys = np.random.default_rng(seed).integers(0, 2**63, size=rounds, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _round(self, right: np.ndarray, key: np.uint64) -> np.ndarray:
+        # splitmix64-style mixing
+        x = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+        x ^= x >> np.uint64(32)
+        x *= np.uint64(0xBF58476D1CE4E5B9)
+        x ^= x >> np.uint64(29)
+        return x & self.mask
+
+    def _encrypt(self, x: np.ndarray) -> np.ndarray:
+        half = np.uint64(self.half)
+        left, right = x >> half, x & self.mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << half) | right
+
+    def take(self, indices) -> np.ndarray:
+        """Return the permuted values of an array of positions in ``[0, n)``."""
+        x = np.asarray(indices, dtype=np.uint64)
+        y = self._encrypt(x)
+        outside = np.flatnonzero(y >= self.n)
+        while len(outside) > 0:
+            y[outside] = self._encrypt(y[outside])
+            outside = outside[y[outside] >= self.n]
+        return y.astype(np.int64)
+
+    def __getitem__(self, i: int) -> int:
+        if not 0 <= i < self.n:
+            raise IndexError(f"index {i} out of range for permutation of {self.n}")
+        return int(self.take([i])[0])
+
+
+class LazyDistributedSampler(DistributedSampler[T_co]):
+    r"""A :class:`DistributedSampler` that does not materialize the permutation.
+
+    This yields the same kind of sequence as :class:`DistributedSampler`: a
+    permutation of the dataset, padded by repeating it from the start or cut
+    to ``self.total_size``, of which each rank takes every
+    ``num_replicas``-th element starting at its rank. The permutation is a
+    :class:`LazyPermutation`, so memory is constant and each index costs O(1)
+    regardless of the size of the dataset, and resuming from a
+    :meth:`state_dict` takes O(1) time. The orders differ from the ones of
+    :class:`DistributedSampler` for the same seed.
+
+    Args:
+        same as :class:`DistributedSampler`, plus
+        chunk_size (int, optional): number of indices computed at once.
+    """
+
+    def __init__(self, *args, chunk_size: int = 65536, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.chunk_size = chunk_size
+
+    def __iter__(self) -> Iterator[T_co]:
+        n = len(self.dataset)  # type: ignore[arg-type]
+        perm = LazyPermutation(n, seed=[self.seed, self.epoch]) if self.shuffle else None
+        return self._count(self._chunks(n, perm, self._start()))
+
+    def _chunks(self, n: int, perm: Optional[LazyPermutation], begin: int) -> Iterator[T_co]:
+        step = self.num_replicas
+        for start in range(begin, self.num_samples, self.chunk_size):
+            count = min(self.chunk_size, self.num_samples - start)
+            # positions in the padded (or cut) sequence shared by all ranks
+            positions = (self.rank + (start + np.arange(count, dtype=np.int64)) * step) % n
+            indices = perm.take(positions) if perm is not None else positions
+            yield from indices.tolist()
@@ -1,11 +1,10 @@
 from fire import Fire
-from ...utils.io import save_json
+from ...utils.io import save_json, load_json
 from ...utils import default
+from ...data.wids.wids_utils import count_samples_parallel
 import glob
 import os
 import os.path as osp
-from webdataset import WebLoader
-from tqdm import tqdm
 
 """
 Example of json file
@@ -17,6 +16,7 @@ Example of json file
       "url": "path/to/shard1",
       "nsamples": 1000,
       "filesize": 123456,
+      "mtime_ns": 1700000000000000000,
       "dataset": "optional dataset identifier or description for shard 1"
     },
     {
@@ -36,15 +36,11 @@ Example of json file
 """
 
 
-def count_samples(tarfile, num_workers=0):
-    loader = WebLoader(tarfile, num_workers=num_workers)
-    cnt = 0
-    for _ in loader:
-        cnt += 1
-    return cnt
-
-
-def main(input_dir, dataset, name=None, num_workers=8, output_file=None):
+def main(input_dir, dataset, name=None, num_workers=8, output_file=None, incremental=False):
+    """
+    incremental: reuse the counts of an existing output file for shards whose size and
+        modification time (the `filesize` and `mtime_ns` of their entries) are unchanged
+    """
     tarfiles = glob.glob(f"{input_dir}/*.tar")
     input_dir = osp.abspath(input_dir)
 
@@ -60,13 +56,34 @@ def main(input_dir, dataset, name=None, num_workers=8, output_file=None):
         "base_path": input_dir,
         "wids_version": 1,
     }
+    previous = {}
+    if incremental and osp.exists(output_file):
+        for shard in load_json(output_file)["shardlist"]:
+            previous[shard["url"]] = shard
+
+    counts = {}
+    stats = {}
+    todo = []
+    for tarfile in tarfiles:
+        # stat before counting, so that a shard changed meanwhile is counted again next time
+        st = stats[tarfile] = os.stat(tarfile)
+        old = previous.get(osp.basename(tarfile))
+        if old is not None and old["filesize"] == st.st_size and old.get("mtime_ns") == st.st_mtime_ns:
+            counts[tarfile] = old["nsamples"]
+        else:
+            todo.append(tarfile)
+    if incremental:
+        print(f"=> Reusing {len(counts)} shards, counting {len(todo)}")
+
+    counts.update(zip(todo, count_samples_parallel(todo, num_workers=num_workers)))
     shardlist = []
-    for tarfile in tqdm(tarfiles, desc="Counting samples"):
+    for tarfile in tarfiles:
         shardlist.append(
             {
                 "url": osp.basename(tarfile),
-                "nsamples": count_samples(tarfile, num_workers=num_workers),
-                "filesize": osp.getsize(tarfile),
+                "nsamples": counts[tarfile],
+                "filesize": stats[tarfile].st_size,
+                "mtime_ns": stats[tarfile].st_mtime_ns,
                 "dataset": dataset,
             }
         )
@@ -77,4 +94,5 @@ def main(input_dir, dataset, name=None, num_workers=8, output_file=None):
     print(f"=> Saved to {output_file}")
 
 
-Fire(main)
+if __name__ == "__main__":
+    Fire(main)
@@ -0,0 +1,51 @@
+import itertools
+
+from torch.utils.data import ConcatDataset, Dataset
+
+from kn_util.data.samplers.multi_source_sampler import GroupMultiSourceSampler
+
+
+class ShapesDataset(Dataset):
+    def __init__(self, shapes):
+        self.shapes = shapes
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        return idx
+
+    def get_data_info(self, idx):
+        width, height = self.shapes[idx]
+        return dict(width=width, height=height)
+
+
+def make_sampler():
+    dataset = ConcatDataset(
+        [
+            ShapesDataset([(1, 2), (2, 1), (3, 1)] * 7),
+            ShapesDataset([(2, 1), (1, 3)] * 11),
+        ]
+    )
+    return GroupMultiSourceSampler(dataset, batch_size=5, source_ratio=[2, 3], seed=3)
+
+
+def test_group_sampler_is_seeded():
+    a = list(itertools.islice(make_sampler(), 200))
+    b = list(itertools.islice(make_sampler(), 200))
+    assert a == b
+
+
+def test_group_sampler_resumes():
+    expected = list(itertools.islice(make_sampler(), 200))
+    for position in [0, 5, 37, 120]:
+        sampler = make_sampler()
+        sampler.load_state_dict(dict(epoch=0, seed=3, position=position))
+        assert list(itertools.islice(sampler, 200 - position)) == expected[position:]
+
+    sampler = make_sampler()
+    list(itertools.islice(sampler, 63))
+    state = sampler.state_dict()
+    resumed = make_sampler()
+    resumed.load_state_dict(state)
+    assert list(itertools.islice(resumed, 37)) == expected[63:100]
@@ -0,0 +1,50 @@
+import multiprocessing
+import sqlite3
+
+from kn_util.data.wids.wids_cleanup import CacheIndex, ShardDiskCache, cache_index
+
+
+def stored_paths(cache_dir):
+    with sqlite3.connect(str(cache_dir / "cache.db")) as connection:
+        return sorted(path for (path,) in connection.execute("SELECT path FROM shards"))
+
+
+def record_without_close(cache_dir, path):
+    CacheIndex(str(cache_dir), batch_size=1000, flush_interval=1e9).record(path, 10)
+
+
+def test_close_flushes(tmp_path):
+    index = CacheIndex(str(tmp_path), batch_size=1000, flush_interval=1e9)
+    index.record("a", 10)
+    index.record_url("http://x/a", "a")
+    assert stored_paths(tmp_path) == []
+    index.close()
+    assert stored_paths(tmp_path) == ["a"]
+
+
+def test_exiting_worker_flushes(tmp_path):
+    CacheIndex(str(tmp_path)).totals()
+    process = multiprocessing.get_context("fork").Process(target=record_without_close, args=(tmp_path, "b"))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    assert stored_paths(tmp_path) == ["b"]
+
+
+def test_totals_and_lru_order(tmp_path):
+    index = CacheIndex(str(tmp_path))
+    for i in range(200):
+        index.record(f"s{i:03d}", 10, now=1000 - i)
+    index.record("s199", 5, pins=1, now=2000)
+    index.record("s000", 20)
+    assert index.totals() == (200 * 10 - 5 + 10, 200)
+    entries = list(index.lru(batch_size=7))
+    assert [path for _, path, _ in entries] == [f"s{i:03d}" for i in range(198, -1, -1)] + ["s199"]
+    index.forget(["s000", "s001"])
+    assert index.totals() == (200 * 10 - 5 + 10 - 30, 198)
+    index.close()
+    assert CacheIndex(str(tmp_path)).totals() == (200 * 10 - 5 + 10 - 30, 198)
+
+
+def test_cache_index_is_shared(tmp_path):
+    assert ShardDiskCache(str(tmp_path)).index is cache_index(str(tmp_path) + "/")
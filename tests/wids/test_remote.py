@@ -0,0 +1,143 @@
+import contextlib
+import http.server
+import io
+import os
+import re
+import threading
+from functools import partial
+
+import pytest
+
+from kn_util.data.wids import wids_dl
+from kn_util.data.wids.wids import ShardListDataset
+from kn_util.data.wids.wids_bench import QuietHandler, make_shard
+from kn_util.data.wids.wids_dl import RangesNotSupported, http_size
+from kn_util.data.wids.wids_index import index_local_shard
+from kn_util.data.wids.wids_mmtar import MMIndexedTar
+from kn_util.data.wids.wids_remote import RemoteIndexedTar
+from kn_util.data.wids.wids_tarindex import shm_index_file, sibling_index_file
+
+
+class RangeHandler(QuietHandler):
+    """Serve files with support for single byte-range requests."""
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        with open(path, "rb") as stream:
+            data = stream.read()
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is None:
+            self.send_response(200)
+        else:
+            lo = int(match.group(1))
+            hi = min(int(match.group(2)) if match.group(2) else len(data) - 1, len(data) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {lo}-{hi}/{len(data)}")
+            data = data[lo : hi + 1]
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return io.BytesIO(data)
+
+
+@contextlib.contextmanager
+def serve(directory, handler=RangeHandler):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), partial(handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_retries(monkeypatch):
+    monkeypatch.setitem(wids_dl.http_options, "retries", 0)
+
+
+@pytest.fixture
+def shard(tmp_path):
+    directory = tmp_path / "srv"
+    directory.mkdir()
+    return make_shard(str(directory / "shard.tar"), 50, member_size=3000)
+
+
+def local_members(path):
+    reader = MMIndexedTar(path)
+    members = [(name, data.read()) for name, data in (reader.get_file(i) for i in range(len(reader)))]
+    reader.close()
+    return members
+
+
+def test_size_probe(shard):
+    directory = os.path.dirname(shard)
+    with serve(directory) as base:
+        assert http_size(base + "shard.tar") == os.path.getsize(shard)
+    with serve(directory, QuietHandler) as base:
+        with pytest.raises(RangesNotSupported):
+            http_size(base + "shard.tar")
+
+
+def test_range_reads_match_local_reads(shard):
+    expected = local_members(shard)
+    with serve(os.path.dirname(shard)) as base:
+        reader = RemoteIndexedTar(base + "shard.tar", block_size=4096, cache_blocks=4)
+        assert [reader.get_file(i)[0] for i in range(len(reader))] == [name for name, _ in expected]
+        for i in [0, 7, len(expected) - 1, 3]:
+            assert reader.get_at_index(i) == expected[i]
+        reader.load_members(range(10, 20))
+        assert [reader.get_at_index(i) for i in range(10, 20)] == expected[10:20]
+        reader.close()
+
+
+def test_index_fallbacks(shard, tmp_path):
+    url_path = "shard.tar"
+    local_index = str(tmp_path / "local.widx")
+    with serve(os.path.dirname(shard)) as base:
+        # no index anywhere: the tar headers are walked remotely, and the index is saved
+        reader = RemoteIndexedTar(base + url_path, index_file=local_index, block_size=4096)
+        walked = reader.file.requests
+        reader.close()
+        assert walked > 1 and os.path.exists(local_index)
+
+        # a valid local index is used without requests
+        reader = RemoteIndexedTar(base + url_path, index_file=local_index, block_size=4096)
+        assert reader.file.requests == 0
+        assert reader.get_at_index(5) == local_members(shard)[5]
+        reader.close()
+
+        # an index published next to the shard is fetched instead of walking the headers
+        os.unlink(local_index)
+        index_local_shard(shard, index_file=sibling_index_file(shard))
+        reader = RemoteIndexedTar(base + url_path, index_file=local_index, block_size=4096)
+        assert reader.file.requests == 0 and os.path.exists(local_index)
+        reader.close()
+
+
+def test_shm_index_is_removed_on_close(shard, tmp_path):
+    index_file = shm_index_file(str(tmp_path / "cache" / "shard.tar"))
+    with serve(os.path.dirname(shard)) as base:
+        reader = RemoteIndexedTar(base + "shard.tar", index_file=index_file)
+        assert os.path.exists(index_file)
+        reader.close()
+    assert not os.path.exists(index_file)
+
+
+def test_dataset_range_reads(shard, tmp_path):
+    local = ShardListDataset([(shard, 50)], transformations=[])
+    with serve(os.path.dirname(shard)) as base:
+        remote = ShardListDataset(
+            [(base + "shard.tar", 50)], transformations=[], range_reads=True, cache_dir=str(tmp_path / "cache")
+        )
+        for i in [0, 13, 49]:
+            a, b = local[i], remote[i]
+            assert a["__key__"] == b["__key__"]
+            assert {k: v.read() for k, v in a.items() if k.startswith(".")} == {
+                k: v.read() for k, v in b.items() if k.startswith(".")
+            }
+        remote.close()
+    local.close()
@@ -0,0 +1,43 @@
+import numpy as np
+
+from kn_util.data.wids.wids import DistributedShardSampler, partition_shards
+
+
+class FakeDataset:
+    def __init__(self, lengths):
+        self.lengths = lengths
+
+
+def test_partition_shards_is_balanced():
+    lengths = list(range(100, 116))
+    for rng in [None, np.random.default_rng(0), np.random.default_rng(1)]:
+        bins = partition_shards(lengths, 4, rng=rng)
+        assert sorted(i for b in bins for i in b) == list(range(16))
+        totals = [sum(lengths[i] for i in b) for b in bins]
+        assert max(totals) - min(totals) <= 2 * max(lengths)
+
+
+def test_assignment_changes_across_epochs():
+    lengths = list(range(100, 116))
+    samplers = [
+        DistributedShardSampler(FakeDataset(lengths), num_replicas=2, rank=rank, num_workers=2, seed=0)
+        for rank in range(2)
+    ]
+    assignments = []
+    for epoch in range(3):
+        for sampler in samplers:
+            sampler.set_epoch(epoch)
+        bins = samplers[0].assignment()
+        assert bins == samplers[1].assignment()
+        assert sorted(i for b in bins for i in b) == list(range(16))
+        assignments.append(sorted(sorted(b) for b in bins))
+    assert assignments[0] != assignments[1] and assignments[1] != assignments[2]
+    assert samplers[0].assignment() == samplers[0].assignment()
+
+
+def test_assignment_without_shuffle_is_fixed():
+    lengths = list(range(100, 116))
+    sampler = DistributedShardSampler(FakeDataset(lengths), num_replicas=2, rank=0, num_workers=2, shuffle=False)
+    bins = sampler.assignment()
+    sampler.set_epoch(1)
+    assert sampler.assignment() == bins
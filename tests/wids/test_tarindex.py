@@ -0,0 +1,76 @@
+import fcntl
+import gzip
+import os
+import threading
+
+from kn_util.data.wids.wids_bench import make_shard
+from kn_util.data.wids.wids_tar import TarFileReader
+from kn_util.data.wids.wids_tarindex import (
+    find_index_file,
+    lock_file,
+    remove_index_file,
+    remove_lock_file,
+    unlock_file,
+)
+
+
+def test_index_build_leaves_no_lock_file(tmp_path):
+    shard = make_shard(str(tmp_path / "shard.tar"), 10)
+    reader = TarFileReader(shard, index_file=find_index_file)
+    names = [reader.get_file(i)[0] for i in range(len(reader))]
+    reader.close()
+    assert sorted(os.listdir(tmp_path)) == ["shard.tar", "shard.tar.widx"]
+    reader = TarFileReader(shard, index_file=find_index_file)
+    assert [reader.get_file(i)[0] for i in range(len(reader))] == names
+    reader.close()
+    remove_index_file(shard)
+    assert os.listdir(tmp_path) == ["shard.tar"]
+
+
+def test_lock_file_is_exclusive_and_removed(tmp_path):
+    path = str(tmp_path / "x.lock")
+    fd = lock_file(path)
+    acquired = []
+
+    def waiter():
+        other = lock_file(path)
+        acquired.append(True)
+        unlock_file(path, other)
+
+    thread = threading.Thread(target=waiter)
+    thread.start()
+    thread.join(0.2)
+    assert not acquired
+    unlock_file(path, fd)
+    thread.join()
+    assert acquired and not os.path.exists(path)
+
+
+def test_remove_lock_file_spares_held_locks(tmp_path):
+    path = str(tmp_path / "x.lock")
+    fd = lock_file(path)
+    remove_lock_file(path)
+    assert os.path.exists(path)
+    unlock_file(path, fd)
+
+    # a lock file left behind by a dead process
+    with open(path, "w") as stream:
+        fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+    remove_lock_file(path)
+    assert not os.path.exists(path)
+
+
+def test_compressed_tar_reads(tmp_path):
+    shard = make_shard(str(tmp_path / "shard.tar"), 20)
+    with open(shard, "rb") as src, gzip.open(str(tmp_path / "shard.tar.gz"), "wb") as dst:
+        dst.write(src.read())
+    plain = TarFileReader(shard, index_file=None, verbose=False)
+    expected = [(name, data.read()) for name, data in plain.get_files(range(len(plain)), num_threads=1)]
+    plain.close()
+    for index_file in [None, find_index_file, find_index_file]:
+        reader = TarFileReader(str(tmp_path / "shard.tar.gz"), index_file=index_file, verbose=False)
+        assert reader.fd is None
+        indexes = list(reversed(range(len(reader))))
+        files = reader.get_files(indexes, num_threads=4)
+        assert [(name, data.read()) for name, data in files] == [expected[i] for i in indexes]
+        reader.close()